@@ -6,6 +6,13 @@ import argparse
 import signal
 import subprocess
 import errno
+import glob
+import heapq
+import math
+import mimetypes
+import sqlite3
+import time
+import uuid
 
 import logging.config
 # noinspection PyUnresolvedReferences
@@ -20,12 +27,31 @@ from google.cloud import storage
 # noinspection PyUnresolvedReferences
 from google.cloud.logging.handlers import CloudLoggingHandler
 
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from json import JSONDecodeError
 from pathlib import Path
 
 extract_status_json_data = None
 
+# written to <table>/<date>/ once all the export files of the partition are published
+COMMIT_MARKER = "_COMMITTED"
+# label index sidecar of <table>/<date>/, read with src/label_index.py
+LABEL_INDEX = "_label_index.json"
+
+# a composite object is composed of at most 32 components per compose request
+COMPOSE_MAX_COMPONENTS = 32
+
+# pending partition exports of the run, see ExportQueue
+export_queue = None
+
+# performance data of the run, appended to the run history, see RunStats
+run_stats = None
+
+# set by the termination signal handler in daemon mode; export loops stop before the next partition
+drain_requested = False
+
 print("get working directory:: {}".format(os.getcwd()))
 
 # Configure Logging
@@ -50,6 +76,329 @@ stackdriver_handler.setFormatter(cloud_log_formatter)
 logger.addHandler(stackdriver_handler)
 
 
+class GcsMetadataCache:
+
+    def __init__(self, storage_client):
+        """
+        Memoize bucket and blob metadata lookups for the duration of a run.
+        Entries are updated on the exporter's own writes, so they do not go stale within a run.
+        """
+        self.storage_client = storage_client
+        self.buckets = {}
+        self.blobs_exist = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_bucket(self, bucket_name):
+        if self.buckets.get(bucket_name) is not None:
+            self.hits += 1
+            return self.buckets[bucket_name]
+
+        self.misses += 1
+        self.buckets[bucket_name] = self.storage_client.get_bucket(bucket_name)
+        return self.buckets[bucket_name]
+
+    def lookup_bucket(self, bucket_name):
+        if bucket_name in self.buckets:
+            self.hits += 1
+            return self.buckets[bucket_name]
+
+        self.misses += 1
+        self.buckets[bucket_name] = self.storage_client.lookup_bucket(bucket_name)
+        return self.buckets[bucket_name]
+
+    def blob_exists(self, blob):
+        key = (blob.bucket.name, blob.name)
+        if key in self.blobs_exist:
+            self.hits += 1
+            return self.blobs_exist[key]
+
+        self.misses += 1
+        self.blobs_exist[key] = blob.exists()
+        return self.blobs_exist[key]
+
+    def mark_written(self, blob):
+        self.blobs_exist[(blob.bucket.name, blob.name)] = True
+
+    def mark_deleted(self, blob):
+        self.blobs_exist[(blob.bucket.name, blob.name)] = False
+
+
+class ExportQueue:
+
+    def __init__(self, backfill_share):
+        """
+        Pending partition exports, served newest partition first.
+        backfill_share of the slots is reserved for the oldest pending partition, so old history still advances.
+        """
+        self.backfill_share = backfill_share
+        self.pending = {}
+        self.recent = []
+        self.backfill = []
+        self.served = 0
+        self.backfill_served = 0
+        # partitions whose last export attempt failed: consecutive failed attempts and time of the last failure,
+        # see run_export_queue
+        self.failed = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, export_date):
+        return export_date in self.pending
+
+    def add(self, export_date, reason):
+        # a partition is queued once, with all the reasons it needs to be exported
+        if export_date in self.pending:
+            self.pending[export_date].add(reason)
+            return
+
+        self.pending[export_date] = {reason}
+        heapq.heappush(self.recent, -int(export_date))
+        heapq.heappush(self.backfill, int(export_date))
+
+    def pop(self):
+        if self.backfill_served < self.backfill_share * self.served:
+            self.backfill_served += 1
+            heap, sign = self.backfill, 1
+        else:
+            heap, sign = self.recent, -1
+
+        # every partition is in both heaps, skip the entries already served from the other one
+        export_date = str(sign * heapq.heappop(heap))
+        while export_date not in self.pending:
+            export_date = str(sign * heapq.heappop(heap))
+
+        self.served += 1
+        return export_date, self.pending.pop(export_date)
+
+
+class LabelIndexBuilder:
+
+    def __init__(self, export_date):
+        """
+        Build the label index sidecar of a partition while its export files are verified:
+        label key/value -> shard and row-range postings, plus min/max cost and usage_start_time per shard.
+        """
+        self.export_date = export_date
+        self.shards = {}
+        self.labels = {}
+
+    def add_shard(self, shard_name, lines):
+        # postings are [start_row, end_row, start_byte, end_byte] ranges, end exclusive, of consecutive rows carrying the label
+        shard = {"rows": 0, "bytes": 0, "min_cost": None, "max_cost": None, "min_usage_start_time": None, "max_usage_start_time": None}
+
+        for line in lines:
+            row = shard["rows"]
+            start_byte = shard["bytes"]
+            end_byte = start_byte + len(line)
+            record = json.loads(line)
+
+            cost = record.get("cost")
+            if cost is not None:
+                shard["min_cost"] = cost if shard["min_cost"] is None else min(shard["min_cost"], cost)
+                shard["max_cost"] = cost if shard["max_cost"] is None else max(shard["max_cost"], cost)
+
+            usage_start_time = record.get("usage_start_time")
+            if usage_start_time is not None:
+                shard["min_usage_start_time"] = usage_start_time if shard["min_usage_start_time"] is None else min(shard["min_usage_start_time"], usage_start_time)
+                shard["max_usage_start_time"] = usage_start_time if shard["max_usage_start_time"] is None else max(shard["max_usage_start_time"], usage_start_time)
+
+            for label in record.get("labels") or []:
+                ranges = self.labels.setdefault(label["key"], {}).setdefault(label["value"], {}).setdefault(shard_name, [])
+                if ranges and ranges[-1][1] >= row:
+                    ranges[-1][1] = row + 1
+                    ranges[-1][3] = end_byte
+                else:
+                    ranges.append([row, row + 1, start_byte, end_byte])
+
+            shard["rows"] = row + 1
+            shard["bytes"] = end_byte
+
+        self.shards[shard_name] = shard
+        return shard["rows"]
+
+    def to_json(self):
+        return json.dumps({
+            "version": 1,
+            "export_date_partition": self.export_date,
+            "shards": self.shards,
+            "labels": self.labels
+        }, separators=(",", ":"))
+
+
+class ParallelTransfer:
+
+    def __init__(self, storage_client, parallelism, chunk_bytes, threshold_bytes):
+        """
+        Upload large objects as parallel parts joined with compose, and download them as parallel byte ranges.
+        Objects below threshold_bytes are transferred with a single request.
+        """
+        self.storage_client = storage_client
+        self.parallelism = parallelism
+        self.chunk_bytes = chunk_bytes
+        self.threshold_bytes = threshold_bytes
+        self.executor = ThreadPoolExecutor(max_workers=parallelism)
+
+        configure_connection_pool(storage_client, parallelism)
+
+    def get_ranges(self, size, max_ranges=None):
+        # (start, end) byte ranges of chunk_bytes, end exclusive, widened to fit in max_ranges
+        range_bytes = self.chunk_bytes if max_ranges is None else max(self.chunk_bytes, -(-size // max_ranges))
+        return [(start, min(start + range_bytes, size)) for start in range(0, size, range_bytes)]
+
+    def is_parallel(self, size):
+        return self.parallelism > 1 and size >= self.threshold_bytes
+
+    def compose_parts(self, blob, size, read_part, content_type):
+        # upload the parts to temporary objects next to the blob, compose them into the blob and delete them
+        token = uuid.uuid4().hex[:8]
+        parts = [(blob.bucket.blob("{}.part-{}-{:02d}".format(blob.name, token, index)), start, end)
+                 for index, (start, end) in enumerate(self.get_ranges(size, COMPOSE_MAX_COMPONENTS))]
+
+        def upload_part(part):
+            part_blob, start, end = part
+            part_blob.upload_from_string(read_part(start, end), content_type=content_type)
+            return part_blob
+
+        futures = [self.executor.submit(upload_part, part) for part in parts]
+        uploaded_parts = []
+        try:
+            for future in futures:
+                uploaded_parts.append(future.result())
+            blob.content_type = content_type
+            blob.compose([part_blob for part_blob, start, end in parts])
+        finally:
+            for future in futures[len(uploaded_parts):]:
+                if not future.cancel() and future.exception() is None:
+                    uploaded_parts.append(future.result())
+            # an empty batch raises on exit and would hide the error of the upload
+            if uploaded_parts:
+                with self.storage_client.batch():
+                    for part_blob in uploaded_parts:
+                        blob.bucket.delete_blob(part_blob.name)
+
+        logger.debug("Uploaded {} ({} bytes) in {} parallel parts".format(blob.name, size, len(parts)))
+
+    def upload_from_string(self, blob, data, content_type="text/plain"):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        if not self.is_parallel(len(data)):
+            blob.upload_from_string(data, content_type=content_type)
+            return
+
+        self.compose_parts(blob, len(data), lambda start, end: data[start:end], content_type)
+
+    def upload_from_filename(self, blob, filename, content_type=None):
+        size = os.path.getsize(filename)
+
+        if not self.is_parallel(size):
+            blob.upload_from_filename(filename, content_type=content_type)
+            return
+
+        def read_part(start, end):
+            with open(filename, "rb") as fin:
+                fin.seek(start)
+                return fin.read(end - start)
+
+        self.compose_parts(blob, size, read_part, content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream")
+
+    def is_parallel_download(self, blob):
+        # listed blobs carry their size, the others (e.g. status files) are downloaded in one request
+        # instead of paying a metadata request for their size
+        return blob.size is not None and self.is_parallel(blob.size)
+
+    def download_as_string(self, blob):
+        if not self.is_parallel_download(blob):
+            return blob.download_as_string()
+
+        size = blob.size
+
+        # GCS byte ranges are end inclusive
+        chunks = list(self.executor.map(lambda byte_range: blob.download_as_string(start=byte_range[0], end=byte_range[1] - 1),
+                                        self.get_ranges(size)))
+        data = b"".join(chunks)
+        if len(data) != size:
+            raise Exception("Parallel download of {} returned {} bytes instead of {}".format(blob.name, len(data), size))
+
+        logger.debug("Downloaded {} ({} bytes) in {} parallel byte ranges".format(blob.name, size, len(chunks)))
+        return data
+
+    def download_to_filename(self, blob, filename):
+        if not self.is_parallel_download(blob):
+            blob.download_to_filename(filename)
+            return
+
+        size = blob.size
+
+        with open(filename, "wb") as fout:
+            fout.truncate(size)
+
+        def download_range(byte_range):
+            data = blob.download_as_string(start=byte_range[0], end=byte_range[1] - 1)
+            if len(data) != byte_range[1] - byte_range[0]:
+                raise Exception("Parallel download of {} returned {} bytes for range {}".format(blob.name, len(data), byte_range))
+            with open(filename, "r+b") as fout:
+                fout.seek(byte_range[0])
+                fout.write(data)
+
+        ranges = self.get_ranges(size)
+        list(self.executor.map(download_range, ranges))
+
+        logger.debug("Downloaded {} ({} bytes) in {} parallel byte ranges".format(blob.name, size, len(ranges)))
+
+
+def configure_connection_pool(storage_client, pool_size):
+    # the requests session of the storage client keeps 10 connections per host, size it for one connection
+    # per parallel transfer plus the requests of the main thread
+    http = getattr(storage_client, "_http", None)
+    if http is not None:
+        # requests comes with the storage client, imported only when there is a session to configure
+        from requests.adapters import HTTPAdapter
+        http.mount("https://", HTTPAdapter(pool_connections=pool_size + 1, pool_maxsize=pool_size + 1))
+
+
+class RunStats:
+
+    def __init__(self, mode, gcs_metadata_misses=0):
+        """
+        Performance data of a run, appended to the run history when the status files are saved
+        """
+        self.run_id = datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-3]
+        self.mode = mode
+        # cache misses before the run started, the metadata lookups of the run are the misses since then
+        self.gcs_metadata_misses = gcs_metadata_misses
+        self.started = time.time()
+        # a daemon run spans the polls until partitions are exported, the waits between them are not run time
+        self.idle_seconds = 0
+        self.phases = {}
+        self.partitions = 0
+        self.failed_partitions = 0
+        self.bytes = 0
+        self.api_calls = 0
+        self.retries = 0
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - started
+
+    @contextmanager
+    def idle(self):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.idle_seconds += time.time() - started
+
+    def duration(self):
+        return time.time() - self.started - self.idle_seconds
+
+
 class Config:
 
     # Check if config.ini exists and load/generate it
@@ -59,14 +408,36 @@ class Config:
         """
         self.storage_client = storage.Client()
         self.big_query_client = bigquery.Client()
+        self.gcs_metadata_cache = GcsMetadataCache(self.storage_client)
 
         self.bucket_name = config['destination_bucket']
-        self.gcs_bucket = self.storage_client.get_bucket(self.bucket_name)
+        self.gcs_bucket = self.gcs_metadata_cache.get_bucket(self.bucket_name)
 
         self.project = config['source_project_id']
         self.dataset_id = config['source_dataset_id']
         self.table_id = config['source_table_id']
 
+        # source dataset location, detected on first use unless overridden for this table in the exporter-config
+        self.source_location = config.get('source_location')
+        # "warn" or "refuse" when the destination bucket is outside the source dataset location
+        self.cross_region_egress = config.get('cross_region_egress', 'warn')
+        # share of the export queue reserved for the oldest pending partitions
+        self.backfill_share = config.get('backfill_share', 0.2)
+        # partitions above split_partition_bytes (total logical bytes) are exported as parallel sub-ranges,
+        # split by usage_start_time "hour" or by "hash" of the row into split_ranges sub-ranges. Off unless set:
+        # every sub-range is an EXPORT DATA query scanning (and billing) the whole partition, the extract job is free
+        self.split_partition_bytes = config.get('split_partition_bytes')
+        self.split_by = config.get('split_by', 'hour')
+        self.split_ranges = config.get('split_ranges', 16)
+        self.split_parallelism = config.get('split_parallelism', 4)
+        # objects from parallel_transfer_bytes up are moved in transfer_chunk_bytes parts over transfer_parallelism streams
+        self.transfer = ParallelTransfer(self.storage_client,
+                                         config.get('transfer_parallelism', 8),
+                                         config.get('transfer_chunk_bytes', 8 * 1024 ** 2),
+                                         config.get('parallel_transfer_bytes', 32 * 1024 ** 2))
+        # last partition metadata lookup of the run, see get_partition_metadata
+        self.partition_metadata = None
+
         logger.info("{} - config data passed : {}".format(self.table_id, config))
 
 
@@ -114,6 +485,9 @@ class Config:
 
         self.log_file = log_file
         self.gcs_log_file_blob = self.gcs_bucket.blob(self.log_file)
+
+        self.run_history_file = "{}/process_status/run_history.db".format(self.table_id)
+        self.gcs_run_history_blob = self.gcs_bucket.blob(self.run_history_file)
         self.logger_name = 'billing-export'
 
 
@@ -155,9 +529,10 @@ def write_to_local_status_file(filename,data):
 
 
 def extract_status_file_exists(config_data):
-    logger.info("{} - config_data.bucket_name: {}  ,config_data.gcs_extract_status_file_blob.exists() :{}".format(config_data.table_id, config_data.bucket_name, config_data.gcs_extract_status_file_blob.exists()))
+    gcs_extract_status_file_exists = config_data.gcs_metadata_cache.blob_exists(config_data.gcs_extract_status_file_blob)
+    logger.info("{} - config_data.bucket_name: {}  ,config_data.gcs_extract_status_file_blob.exists() :{}".format(config_data.table_id, config_data.bucket_name, gcs_extract_status_file_exists))
 
-    if config_data.gcs_extract_status_file_blob.exists() or config_data.local_extract_status_file_path.exists():
+    if gcs_extract_status_file_exists or config_data.local_extract_status_file_path.exists():
         logger.debug("{} - gcs extract file {} or local status file: {} exists".format(config_data.table_id, config_data.gcs_extract_status_file_blob, config_data.local_extract_status_file_path))
         return True
     else:
@@ -168,9 +543,10 @@ def extract_status_file_exists(config_data):
 def get_latest_extract_date_from_statusfile(config_data):
     global extract_status_json_data
 
-    if config_data.gcs_extract_status_file_blob.exists():
+    if config_data.gcs_metadata_cache.blob_exists(config_data.gcs_extract_status_file_blob):
 
-        gcs_json_data_string = config_data.gcs_extract_status_file_blob.download_as_string()
+        gcs_json_data_string = config_data.transfer.download_as_string(config_data.gcs_extract_status_file_blob)
+        count_api_calls()
         gcs_extract_status_json_data = json.loads(gcs_json_data_string)
         gcs_extract_records = gcs_extract_status_json_data['extract_status']
         sorted_extract_list = sorted(gcs_extract_records, key=lambda i: datetime.strptime(i['export_date_partition'], '%Y%m%d'), reverse=True)
@@ -252,6 +628,7 @@ def get_latest_extract_record(json_data):
 
 def start_extract_process():
     global extract_status_json_data
+    global export_queue
 
     # Check if bucket "billing_extract_project" exists
     if lookup_extract_bucket(config_data) is None:
@@ -261,6 +638,8 @@ def start_extract_process():
             "\n{} - {} BUCKET DOES NOT EXIST. CREATE {} BUCKET AND TRY AGAIN ...".format(config_data.table_id, config_data.bucket_name, config_data.bucket_name))
 
     else:
+        check_destination_bucket_location(config_data)
+
         # if Bucket exists, check if process_extract_status.json file exists in the bucket
         # if file exists,
         #       1.verify for failed runs and rerun the extract for those partitions.
@@ -299,9 +678,10 @@ def start_extract_process():
             #   3.run historical extract
             logger.warning("{} - status file DOES NOT EXIST .. proceeding with status folder check ...".format(config_data.table_id))
 
-            if config_data.gcs_process_status_folder_blob.exists() is False:
+            if config_data.gcs_metadata_cache.blob_exists(config_data.gcs_process_status_folder_blob) is False:
                 logger.warning("{} - Extract folder DOES NOT EXIST .. proceeding with creating the folder".format(config_data.table_id))
                 create_folder_in_bucket(config_data.gcs_process_status_folder_blob)
+                config_data.gcs_metadata_cache.mark_written(config_data.gcs_process_status_folder_blob)
 
             create_local_extract_status_file(config_data.extract_status_file)
 
@@ -310,13 +690,19 @@ def start_extract_process():
 
             logger.debug("{} - Historical run from date partition: {} to {} ".format(config_data.table_id, export_start_date, export_end_date))
 
-    logger.info("{} - ... starting extract process ....\n".format(config_data.table_id))
-    extract_billing(export_start_date, export_end_date)
-    logger.info("{} - ... Completed extract process successfully....\n".format(config_data.table_id))
+    # new partitions, failed, restated and mismatched partitions all go into one queue, served newest first
+    export_queue = ExportQueue(config_data.backfill_share)
+
+    with run_stats.phase("plan"):
+        logger.info("{} - ... scheduling extract process ....\n".format(config_data.table_id))
+        extract_billing(export_start_date, export_end_date)
 
-    logger.info("{} - ... Re-run Failed Partions check started... ....\n".format(config_data.table_id))
-    rerun_failed_partions_export(opts)
-    logger.info("{} - ... Completed Re-run Failed Partions successfully....\n".format(config_data.table_id))
+        logger.info("{} - ... Re-run Failed Partions check started... ....\n".format(config_data.table_id))
+        rerun_failed_partions_export(opts)
+
+    logger.info("{} - ... starting extract process for {} partitions ....\n".format(config_data.table_id, len(export_queue)))
+    run_export_queue()
+    logger.info("{} - ... Completed extract process successfully....\n".format(config_data.table_id))
 
 
 def create_folder_in_bucket(folder):
@@ -345,20 +731,78 @@ def create_local_extract_status_file(filename):
 
 
 def lookup_extract_bucket(config_data):
-    return config_data.storage_client.lookup_bucket(config_data.bucket_name) is not None
+    return config_data.gcs_metadata_cache.lookup_bucket(config_data.bucket_name) is not None
+
+
+def get_source_location(config_data):
+    # detect the source dataset location once and use it for every job
+    if config_data.source_location is None:
+        config_data.source_location = config_data.big_query_client.get_dataset(get_dataset_ref(config_data)).location
+        count_api_calls()
+        logger.info("{} - source dataset {}:{} location : {}".format(config_data.table_id, config_data.project, config_data.dataset_id, config_data.source_location))
+
+    return config_data.source_location
+
+
+# regions and dual-regions inside each multi-region, a region is only listed when it is inside the multi-region
+# (e.g. europe-west2 London and europe-west6 Zurich are not in EU)
+MULTI_REGION_MEMBERS = {
+    "US": {"US-CENTRAL1", "US-EAST1", "US-EAST4", "US-EAST5", "US-SOUTH1", "US-WEST1", "US-WEST2", "US-WEST3", "US-WEST4", "NAM4"},
+    "EU": {"EUROPE-CENTRAL2", "EUROPE-NORTH1", "EUROPE-SOUTHWEST1", "EUROPE-WEST1", "EUROPE-WEST3", "EUROPE-WEST4",
+           "EUROPE-WEST8", "EUROPE-WEST9", "EUROPE-WEST10", "EUROPE-WEST12", "EUR4"},
+    "ASIA": {"ASIA-EAST1", "ASIA-EAST2", "ASIA-NORTHEAST1", "ASIA-NORTHEAST2", "ASIA-NORTHEAST3", "ASIA-SOUTH1",
+             "ASIA-SOUTH2", "ASIA-SOUTHEAST1", "ASIA-SOUTHEAST2", "ASIA1"},
+}
+
+
+def locations_compatible(source_location, bucket_location):
+    # same location, or a bucket region/dual-region inside the source multi-region
+    source_location = source_location.upper()
+    bucket_location = bucket_location.upper()
+
+    if source_location == bucket_location:
+        return True
+
+    return bucket_location in MULTI_REGION_MEMBERS.get(source_location, set())
+
+
+def check_destination_bucket_location(config_data):
+    source_location = get_source_location(config_data)
+    bucket_location = config_data.gcs_bucket.location
+
+    if locations_compatible(source_location, bucket_location):
+        logger.debug("{} - destination bucket {} location {} is compatible with source dataset location {}".format(config_data.table_id, config_data.bucket_name, bucket_location, source_location))
+        return True
+
+    message = "{} - destination bucket {} location {} is outside source dataset location {}, export traffic leaves the region".format(config_data.table_id, config_data.bucket_name, bucket_location, source_location)
+
+    if config_data.cross_region_egress == "refuse":
+        logger.error(message)
+        raise Exception(message)
 
+    logger.warning(message)
+    return False
 
-def verify_lines_in_export_json(config_data, export_start_date):
-    prefix = "{}/{}/".format(config_data.table_id,export_start_date)
+
+def verify_lines_in_export_json(config_data, export_start_date, label_index=None):
+    # verify the export files written to the staging prefix, before they are promoted to the partition folder,
+    # and add them to the label index of the partition
+    prefix = get_staging_prefix(config_data, export_start_date)
     blobs = config_data.gcs_bucket.list_blobs(prefix=prefix)
+    count_api_calls()
 
     total_bytes_written = 0
     for blob in blobs:
-        if blob.name.startswith("{}/{}/billing-export-".format(config_data.table_id, export_start_date)):
+        if blob.name.startswith("{}billing-export-".format(prefix)):
             temp_file = "{}/process_status/temp.json".format(config_data.table_id)
-            blob.download_to_filename(temp_file)
-
-            rows = sum(1 for line in open(temp_file))
+            config_data.transfer.download_to_filename(blob, temp_file)
+            count_api_calls()
+
+            with open(temp_file, "rb") as fin:
+                if label_index is not None:
+                    rows = label_index.add_shard(blob.name.replace(prefix, ""), fin)
+                else:
+                    rows = sum(1 for line in fin)
             os.remove(temp_file)
             logger.debug("{} - No of rows in the destination export JSON:{}/{}/{} for date partition:{} is : {} rows".format(config_data.table_id, config_data.table_id,export_start_date,blob.name.replace(prefix, ""),export_start_date,rows))
             bytes = get_extract_json_size(blob)
@@ -367,6 +811,130 @@ def verify_lines_in_export_json(config_data, export_start_date):
     return total_bytes_written
 
 
+def count_api_calls(calls=1):
+    # bucket and blob metadata lookups are counted by the gcs metadata cache
+    if run_stats is not None:
+        run_stats.api_calls += calls
+
+
+def get_staging_prefix(config_data, export_date):
+    return "{}/_staging/{}/".format(config_data.table_id, export_date)
+
+
+def batched(items, size=100):
+    # a batch request carries at most 100 calls
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def delete_blobs(config_data, blob_names):
+    for names in batched(blob_names):
+        with config_data.storage_client.batch():
+            for name in names:
+                config_data.gcs_bucket.delete_blob(name)
+        count_api_calls()
+
+
+def clear_staging_prefix(config_data, export_date, keep_sub_ranges=()):
+    # remove the export files left in the staging prefix by an interrupted run, except the ones of keep_sub_ranges,
+    # and return the sub-ranges of keep_sub_ranges which still have export files
+    staging_prefix = get_staging_prefix(config_data, export_date)
+    staged_blob_names = [blob.name for blob in config_data.gcs_bucket.list_blobs(prefix=staging_prefix)]
+    count_api_calls()
+
+    kept_sub_ranges = [sub_range for sub_range in keep_sub_ranges
+                       if any(name.startswith("{}billing-export-{}-".format(staging_prefix, sub_range)) for name in staged_blob_names)]
+    staged_blob_names = [name for name in staged_blob_names
+                         if not any(name.startswith("{}billing-export-{}-".format(staging_prefix, sub_range)) for sub_range in kept_sub_ranges)]
+
+    if staged_blob_names:
+        logger.debug("{} - Removing {} export files left in the staging prefix of partition {}".format(config_data.table_id, len(staged_blob_names), export_date))
+        delete_blobs(config_data, staged_blob_names)
+
+    return kept_sub_ranges
+
+
+def promote_partition(config_data, export_date, total_bytes_written, label_index=None):
+    # Publish the verified export files of the staging prefix to <table>/<date>/
+    #   1.remove the committed marker, readers only trust the export files listed in it
+    #   2.copy the staged export files to the partition folder
+    #   3.delete the export files of a previous export which are not part of this one, and the staged files
+    #   4.write the label index sidecar, or delete the one of a previous export
+    #   5.write the committed marker listing the export files of the partition
+    staging_prefix = get_staging_prefix(config_data, export_date)
+    partition_prefix = "{}/{}/".format(config_data.table_id, export_date)
+    commit_marker_blob = config_data.gcs_bucket.blob(partition_prefix + COMMIT_MARKER)
+
+    staged_blobs = [blob for blob in config_data.gcs_bucket.list_blobs(prefix=staging_prefix) if blob.name.startswith(staging_prefix + "billing-export-")]
+    shard_names = [blob.name.replace(staging_prefix, "") for blob in staged_blobs]
+    partition_blob_names = [blob.name for blob in config_data.gcs_bucket.list_blobs(prefix=partition_prefix)]
+    count_api_calls(2)
+
+    if commit_marker_blob.name in partition_blob_names:
+        commit_marker_blob.delete()
+        count_api_calls()
+        config_data.gcs_metadata_cache.mark_deleted(commit_marker_blob)
+
+    for blobs in batched(staged_blobs):
+        with config_data.storage_client.batch():
+            for blob in blobs:
+                config_data.gcs_bucket.copy_blob(blob, config_data.gcs_bucket, blob.name.replace(staging_prefix, partition_prefix))
+        count_api_calls()
+
+    stale_blob_names = [name for name in partition_blob_names
+                        if name.startswith(partition_prefix + "billing-export-") and name.replace(partition_prefix, "") not in shard_names]
+    if stale_blob_names:
+        logger.info("{} - Removing {} stale export files of partition {}: {}".format(config_data.table_id, len(stale_blob_names), export_date, stale_blob_names))
+
+    label_index_blob = config_data.gcs_bucket.blob(partition_prefix + LABEL_INDEX)
+    if label_index is None and label_index_blob.name in partition_blob_names:
+        stale_blob_names.append(label_index_blob.name)
+
+    delete_blobs(config_data, stale_blob_names + [blob.name for blob in staged_blobs])
+
+    if label_index is not None:
+        config_data.transfer.upload_from_string(label_index_blob, label_index.to_json(), content_type="application/json")
+        count_api_calls()
+
+    # generations of the promoted export files, readers pin their reads to them
+    shard_generations = {blob.name.replace(partition_prefix, ""): blob.generation
+                         for blob in config_data.gcs_bucket.list_blobs(prefix=partition_prefix + "billing-export-")}
+    count_api_calls()
+
+    write_commit_marker(config_data, export_date, shard_names, shard_generations, total_bytes_written,
+                        label_index_blob.generation if label_index is not None else None)
+
+    logger.debug("{} - Promoted {} export files to {}".format(config_data.table_id, len(shard_names), partition_prefix))
+
+
+def write_commit_marker(config_data, export_date, shard_names, shard_generations, total_bytes_written, label_index_generation=None):
+    commit_marker_blob = config_data.gcs_bucket.blob("{}/{}/{}".format(config_data.table_id, export_date, COMMIT_MARKER))
+    commit_marker_blob.upload_from_string(json.dumps({
+        "export_date_partition": export_date,
+        "shards": shard_names,
+        "generations": {shard_name: shard_generations[shard_name] for shard_name in shard_names},
+        "bytes": total_bytes_written,
+        "label_index": LABEL_INDEX if label_index_generation is not None else None,
+        "label_index_generation": label_index_generation,
+        "committed_timestamp": datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-3]
+    }, indent=4))
+    config_data.gcs_metadata_cache.mark_written(commit_marker_blob)
+    count_api_calls()
+
+
+def commit_unmarked_partition(config_data, export_date, total_bytes_written):
+    # partitions exported before committed markers were written are committed in place, once their export files
+    # match the bytes in the status file. They have no label index, readers scan their export files.
+    partition_prefix = "{}/{}/".format(config_data.table_id, export_date)
+    shard_generations = {blob.name.replace(partition_prefix, ""): blob.generation
+                         for blob in config_data.gcs_bucket.list_blobs(prefix=partition_prefix + "billing-export-")}
+    count_api_calls()
+    shard_names = sorted(shard_generations)
+
+    write_commit_marker(config_data, export_date, shard_names, shard_generations, total_bytes_written)
+    logger.info("{} - Committed partition {} exported without a committed marker, {} export files".format(config_data.table_id, export_date, len(shard_names)))
+
+
 def get_extract_json_size(blob):
 
     return blob.size
@@ -380,24 +948,154 @@ def extract_partition(config_data, table_ref, destination_uri, extract_config, e
             destination_uri,
             job_config=extract_config,
             # Location must match that of the source table.
-            location="US"
+            location=get_source_location(config_data)
         )  # API request
+    count_api_calls()
     try:
-        extract_job.result()  # Waits for job to complete.
+        with run_stats.phase("extract"):
+            extract_job.result()  # Waits for job to complete.
         logger.debug(
                 "{} - Exported {}:{}.{} to {}".format(config_data.table_id, config_data.project, config_data.dataset_id, config_data.table_id+export_start_date, destination_uri)
             )
-        destination_table = config_data.big_query_client.get_table(table_ref)
+        total_bytes_written = publish_staged_partition(config_data, table_ref, export_start_date)
 
-        logger.debug("{} - No of rows extracted from date partition:{} of source table:{} : {} rows".format(config_data.table_id, export_start_date,config_data.table_id,destination_table.num_rows))
+        success = True
+    except Exception:
+        logger.exception("{} - Export of partition {} failed".format(config_data.table_id, export_start_date))
+        success = False
 
-        total_bytes_written = verify_lines_in_export_json(config_data, export_start_date)
+    return success, total_bytes_written
+
+
+def publish_staged_partition(config_data, table_ref, export_start_date):
+    # verify the export files of the staging prefix and promote them to the partition folder
+    destination_table = config_data.big_query_client.get_table(table_ref)
+    count_api_calls()
+
+    logger.debug("{} - No of rows extracted from date partition:{} of source table:{} : {} rows".format(config_data.table_id, export_start_date,config_data.table_id,destination_table.num_rows))
+
+    with run_stats.phase("verify"):
+        label_index = LabelIndexBuilder(export_start_date)
+        total_bytes_written = verify_lines_in_export_json(config_data, export_start_date, label_index)
+
+    with run_stats.phase("promote"):
+        promote_partition(config_data, export_start_date, total_bytes_written, label_index)
+
+    return total_bytes_written
 
+
+def get_sub_ranges(config_data, export_date):
+    # sub-ranges an oversized partition is exported in, empty for a partition exported by a single extract job
+    if not config_data.split_partition_bytes:
+        return []
+
+    if config_data.partition_metadata is None:
+        get_partition_metadata(config_data)
+    metadata = config_data.partition_metadata.get(export_date)
+
+    if metadata is None or (metadata["total_logical_bytes"] or 0) <= config_data.split_partition_bytes:
+        return []
+
+    if config_data.split_by == "hour":
+        return ["h{:02d}".format(hour) for hour in range(24)]
+    elif config_data.split_by == "hash":
+        return ["b{:02d}".format(bucket) for bucket in range(config_data.split_ranges)]
+    else:
+        logger.error("{} - split_by must be hour or hash, not {}".format(config_data.table_id, config_data.split_by))
+        raise Exception("split_by must be hour or hash, not {}".format(config_data.split_by))
+
+
+def get_sub_range_query(config_data, export_date, sub_range):
+    # EXPORT DATA statement writing the rows of a sub-range to billing-export-<sub-range>-*.json in the staging prefix
+    if sub_range.startswith("h"):
+        sub_range_filter = "IFNULL(EXTRACT(HOUR FROM usage_start_time), 0) = {}".format(int(sub_range[1:]))
+    else:
+        sub_range_filter = "MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(t))), {}) = {}".format(config_data.split_ranges, int(sub_range[1:]))
+
+    destination_uri = "gs://{}/{}billing-export-{}-*.json".format(config_data.bucket_name, get_staging_prefix(config_data, export_date), sub_range)
+
+    return str("""EXPORT DATA OPTIONS(uri='{}', format='JSON', overwrite=true) AS
+                select * from `{}.{}.{}` as t
+                where _PARTITIONDATE = PARSE_DATE('%Y%m%d', "{}")
+                and {};""").format(destination_uri, config_data.project, config_data.dataset_id, config_data.table_id,
+                                   export_date, sub_range_filter)
+
+
+def get_extract_record(extract_status_json_data, export_date):
+    return next((record for record in extract_status_json_data['extract_status'] if record['export_date_partition'] == export_date), None)
+
+
+def get_completed_sub_ranges(extract_record, sub_ranges, metadata):
+    # sub-ranges exported by an interrupted export of the partition, if the partition was not modified since the
+    # sub-range export started. Sub-ranges of a published export have no staged files left, see clear_staging_prefix
+    if extract_record is None or sorted(extract_record.get('sub_ranges', {})) != sorted(sub_ranges):
+        return []
+
+    sub_ranges_started = extract_record.get('sub_ranges_started', extract_record['run_timestamp'])
+    if get_utc_datetime(metadata["last_modified_time"]) > datetime.strptime(sub_ranges_started, "%Y%m%d %H:%M:%S.%f"):
+        return []
+
+    return [sub_range for sub_range in sub_ranges if extract_record['sub_ranges'][sub_range] == "success"]
+
+
+def export_sub_range(config_data, export_date, sub_range):
+    config_data.big_query_client.query(get_sub_range_query(config_data, export_date, sub_range), location=get_source_location(config_data)).result()
+
+
+def extract_partition_sub_ranges(config_data, table_ref, export_date, sub_ranges):
+    # Export an oversized partition as parallel sub-ranges
+    #   1.keep the staged export files of the sub-ranges completed by an interrupted export, remove the others
+    #   2.export the remaining sub-ranges in parallel, recording every completed sub-range in the status file
+    #   3.verify and promote the partition once all its sub-ranges are exported
+    # returns the success, the bytes written and the time the partition was read, see export_date_partition
+    extract_record = get_extract_record(extract_status_json_data, export_date)
+    completed_sub_ranges = get_completed_sub_ranges(extract_record, sub_ranges, config_data.partition_metadata[export_date])
+    completed_sub_ranges = clear_staging_prefix(config_data, export_date, completed_sub_ranges)
+    pending_sub_ranges = [sub_range for sub_range in sub_ranges if sub_range not in completed_sub_ranges]
+
+    # sub-ranges kept from an interrupted export read the partition after their export started, an export starting
+    # over from no sub-ranges reads it from now on
+    if not completed_sub_ranges:
+        extract_record['sub_ranges_started'] = datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-3]
+    extract_submitted_timestamp = extract_record.get('sub_ranges_started', extract_record['run_timestamp'])
+
+    extract_record['sub_ranges'] = {sub_range: "success" if sub_range in completed_sub_ranges else "started" for sub_range in sub_ranges}
+    write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
+
+    logger.info("{} - Exporting partition {} in {} sub-ranges by {}, {} already exported".format(config_data.table_id, export_date, len(sub_ranges), config_data.split_by, len(completed_sub_ranges)))
+    logger.info("{} - Each sub-range query scans the whole partition {}, {} bytes billed per query".format(config_data.table_id, export_date,
+                config_data.partition_metadata[export_date]["total_logical_bytes"]))
+
+    failed_sub_ranges = []
+    with run_stats.phase("extract"):
+        with ThreadPoolExecutor(max_workers=config_data.split_parallelism) as executor:
+            futures = {executor.submit(export_sub_range, config_data, export_date, sub_range): sub_range for sub_range in pending_sub_ranges}
+            count_api_calls(len(futures))
+
+            for future in as_completed(futures):
+                sub_range = futures[future]
+                try:
+                    future.result()
+                    extract_record['sub_ranges'][sub_range] = "success"
+                    write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
+                    logger.debug("{} - Exported sub-range {} of partition {}".format(config_data.table_id, sub_range, export_date))
+                except Exception:
+                    logger.exception("{} - Export of sub-range {} of partition {} failed".format(config_data.table_id, sub_range, export_date))
+                    failed_sub_ranges.append(sub_range)
+
+    if failed_sub_ranges:
+        logger.error("{} - {} sub-ranges of partition {} failed, they are retried with the partition: {}".format(config_data.table_id, len(failed_sub_ranges), export_date, sorted(failed_sub_ranges)))
+        return False, 0, extract_submitted_timestamp
+
+    try:
+        total_bytes_written = publish_staged_partition(config_data, table_ref, export_date)
         success = True
-    except:
+    except Exception:
+        logger.exception("{} - Publishing the sub-ranges of partition {} failed".format(config_data.table_id, export_date))
+        total_bytes_written = 0
         success = False
 
-    return success, total_bytes_written
+    return success, total_bytes_written, extract_submitted_timestamp
 
 
 def get_partitions(config_data, export_start_date, export_end_date):
@@ -412,7 +1110,8 @@ def get_partitions(config_data, export_start_date, export_end_date):
     logger.debug("\n{} - Partition Query: \n{}\n".format(config_data.table_id, partition_query))
 
     try:
-        partitions = config_data.big_query_client.query(partition_query, location="US")
+        partitions = config_data.big_query_client.query(partition_query, location=get_source_location(config_data))
+        count_api_calls()
     except:
         logger.error("{} - Partition Query didnot execute. Please check and try again.".format(config_data.table_id))
         raise Exception(
@@ -425,40 +1124,80 @@ def get_dataset_ref(config_data):
     return config_data.big_query_client.dataset(config_data.dataset_id, project=config_data.project)
 
 
-def extract_billing(export_start_date, export_end_date):
+def export_date_partition(dataset_ref, export_date):
     global extract_status_json_data
 
-    partitions = get_partitions(config_data, export_start_date, export_end_date)
+    table_ref = dataset_ref.table(config_data.table_id + "$" + export_date)
+    destination_uri = "gs://{}/{}{}".format(config_data.bucket_name, get_staging_prefix(config_data, export_date), "billing-export-*.json")
 
-    dataset_ref = get_dataset_ref(config_data)
+    extract_config = bigquery.job.ExtractJobConfig()
+    extract_config.destination_format = bigquery.DestinationFormat.NEWLINE_DELIMITED_JSON
 
-    for part in partitions.result():
+    status = "started"
+    total_bytes_written = 0
 
-        table_ref = dataset_ref.table(config_data.table_id + "$" + part[0])
-        destination_uri = "gs://{}/{}/{}/{}".format(config_data.bucket_name, config_data.table_id, part[0], "billing-export-*.json")
+    update_extract_status_json(status, export_date, total_bytes_written)
+    write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
 
-        extract_config = bigquery.job.ExtractJobConfig()
-        extract_config.destination_format = bigquery.DestinationFormat.NEWLINE_DELIMITED_JSON
-        export_start_date = part[0]
+    sub_ranges = get_sub_ranges(config_data, export_date)
 
-        status = "started"
-        total_bytes_written = 0
+    # the partition is read when the extract job is submitted, writes landing during the export are newer than this
+    # timestamp and the partition is picked up as restated, see partition_restated
+    extract_submitted_timestamp = datetime.utcnow().strftime("%Y%m%d %H:%M:%S.%f")[:-3]
+
+    if sub_ranges:
+        success, total_bytes_written, extract_submitted_timestamp = extract_partition_sub_ranges(config_data, table_ref, export_date, sub_ranges)
+    else:
+        clear_staging_prefix(config_data, export_date)
+        success, total_bytes_written = extract_partition(config_data, table_ref, destination_uri, extract_config, export_date)
 
-        update_extract_status_json(status, export_start_date, total_bytes_written)
+    run_stats.partitions += 1
+    if success:
+        status = "success"
+        run_stats.bytes += total_bytes_written
+
+        update_extract_status_json(status, export_date, total_bytes_written, extract_submitted_timestamp)
         write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
+        logger.debug("{} - Export partition completed successfully for : {} \n".format(config_data.table_id, export_date))
+
+    else:
+        run_stats.failed_partitions += 1
+
+    return success
 
-        success, total_bytes_written = extract_partition(config_data, table_ref, destination_uri, extract_config, export_start_date)
 
-        if success:
-            status = "success"
+def extract_billing(export_start_date, export_end_date):
 
-            update_extract_status_json(status, export_start_date, total_bytes_written)
-            write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
-            logger.debug("{} - Export partition completed successfully for : {} \n".format(config_data.table_id, export_start_date))
+    partitions = get_partitions(config_data, export_start_date, export_end_date)
 
+    for part in partitions.result():
+        export_queue.add(part[0], "new")
 
 
-def update_extract_status_json(status, export_start_date, bytes):
+def run_export_queue():
+    # export the queued partitions, newest first, and return the partitions exported successfully
+    dataset_ref = get_dataset_ref(config_data)
+    exported_partitions = []
+
+    while len(export_queue) > 0 and not drain_requested:
+
+        export_date, reasons = export_queue.pop()
+        logger.debug("{} - Export queue: partition {} ({}), {} partitions pending".format(config_data.table_id, export_date, ", ".join(sorted(reasons)), len(export_queue)))
+
+        if reasons & {"failed", "mismatch"}:
+            run_stats.retries += 1
+
+        if export_date_partition(dataset_ref, export_date):
+            exported_partitions.append(export_date)
+            export_queue.failed.pop(export_date, None)
+        else:
+            attempts = export_queue.failed.get(export_date, (0, None))[0]
+            export_queue.failed[export_date] = (attempts + 1, time.time())
+
+    return exported_partitions
+
+
+def update_extract_status_json(status, export_start_date, bytes, extract_submitted_timestamp=None):
     # if status is "success", append "extract_status", "run_timestamp", "export_date_partition" to the file. There is no key for "status" at this point.
     # else if status is "success", insert the record with id as status="success"
     global extract_status_json_data
@@ -478,21 +1217,30 @@ def update_extract_status_json(status, export_start_date, bytes):
         index = next((index for (index, d) in enumerate(extract_status_json_data['extract_status']) if d['export_date_partition'] == export_start_date), None)
         extract_status_json_data['extract_status'][index]['bytes'] = bytes
         extract_status_json_data['extract_status'][index]['status'] = "success"
+        extract_status_json_data['extract_status'][index]['exported_timestamp'] = run_timestamp
+        if extract_submitted_timestamp is not None:
+            extract_status_json_data['extract_status'][index]['extract_submitted_timestamp'] = extract_submitted_timestamp
 
 
 
 def write_to_gcs_status_file(config_data, extract_status_json_data):
-    config_data.gcs_extract_status_file_blob.upload_from_string(json.dumps(extract_status_json_data, indent=4, sort_keys=False))
+    config_data.transfer.upload_from_string(config_data.gcs_extract_status_file_blob, json.dumps(extract_status_json_data, indent=4, sort_keys=False))
+    count_api_calls()
+    config_data.gcs_metadata_cache.mark_written(config_data.gcs_extract_status_file_blob)
 
 
-def upload_file_to_gcs(destination_blob, filename):
-    destination_blob.upload_from_filename(filename)
+def upload_file_to_gcs(destination_blob, filename, transfer=None):
+    if transfer is not None:
+        transfer.upload_from_filename(destination_blob, filename)
+    else:
+        destination_blob.upload_from_filename(filename)
+    count_api_calls()
 
 
 def get_bytes_from_status_file(extract_status_json_data, export_date):
     for data in extract_status_json_data['extract_status']:
         if data['export_date_partition'] == export_date:
-            return data['bytes']
+            return data.get('bytes')
 
 
 def gcs_extract_json_blob_exists(config_data, export_date):
@@ -500,6 +1248,10 @@ def gcs_extract_json_blob_exists(config_data, export_date):
     bytes_from_status_file = get_bytes_from_status_file(extract_status_json_data, export_date)
     prefix = "{}/{}".format(config_data.table_id,export_date )
     blobs = config_data.gcs_bucket.list_blobs(prefix=prefix)
+    count_api_calls()
+
+    commit_marker_blob = config_data.gcs_bucket.blob("{}/{}/{}".format(config_data.table_id, export_date, COMMIT_MARKER))
+    commit_marker_exists = False
 
     total_bytes = 0
     for blob in blobs:
@@ -508,6 +1260,15 @@ def gcs_extract_json_blob_exists(config_data, export_date):
             bytes = get_extract_json_size(blob)
             total_bytes = bytes + total_bytes
 
+        elif blob.name == commit_marker_blob.name:
+            commit_marker_exists = True
+
+    # the listing tells whether the partition is committed, see rerun_failed_partions_export
+    if commit_marker_exists:
+        config_data.gcs_metadata_cache.mark_written(commit_marker_blob)
+    else:
+        config_data.gcs_metadata_cache.mark_deleted(commit_marker_blob)
+
     logger.debug('{} - Bytes of export partition: {} from STATUS FILE: {} bytes'.format(config_data.table_id, export_date, bytes_from_status_file))
 
     logger.debug('{} - Bytes of export partition : {} from GCS LOCATION: {} bytes'.format(config_data.table_id, export_date, total_bytes))
@@ -515,96 +1276,367 @@ def gcs_extract_json_blob_exists(config_data, export_date):
     return bytes_from_status_file == total_bytes
 
 
-def get_all_partitions():
-    partition_query = str("""select distinct format_date('%Y%m%d',_PARTITIONDATE)as parts   
-                from `{}.{}.{}`
-                order by parts asc;""").format(config_data.project, config_data.dataset_id, config_data.table_id)
-    logger.debug("\n{} - Rerun failed partitions: Partition Query: get all partitions: \n{}\n".format(config_data.table_id, partition_query))
+def get_failed_partitions(extract_status_json_data):
+    # records without status key were started but never completed
+    return [record['export_date_partition'] for record in extract_status_json_data['extract_status'] if 'status' not in record]
 
-    try:
-        partitions = config_data.big_query_client.query(partition_query, location="US")
-    except:
-        logger.error("{} - Partition Query didnot execute. Please check and try again.")
-        raise Exception(
-            "Partition Query didnot execute. Please check and try again.")
 
-    return partitions
+def partition_restated(extract_record, metadata):
+    # a successfully exported partition modified in BigQuery after its export
+    if 'status' not in extract_record:
+        return False
+
+    # records of exporter versions before the read time was stored only have the run_timestamp of the extract start,
+    # which the partition is modified after anyway. They are taken as exported up to the current modification once,
+    # and compared from there on
+    if 'extract_submitted_timestamp' not in extract_record and 'exported_timestamp' not in extract_record:
+        extract_record['extract_submitted_timestamp'] = get_utc_datetime(metadata["last_modified_time"]).strftime("%Y%m%d %H:%M:%S.%f")[:-3]
+        return False
+
+    # compared with the time the partition was read by the extract job, records written before it was stored
+    # fall back to the end of the export
+    read_timestamp = extract_record.get('extract_submitted_timestamp', extract_record.get('exported_timestamp'))
+
+    return get_utc_datetime(metadata["last_modified_time"]) > datetime.strptime(read_timestamp, "%Y%m%d %H:%M:%S.%f")
+
+
+def get_utc_datetime(timestamp):
+    # naive utc datetime, as the timestamps of the status file
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
 
 
 def gcs_json_export_file_exists(gcs_json_export_file, gcs_json_export_folder):
 
     gcs_json_export_file_blob = config_data.gcs_bucket.blob(gcs_json_export_file)
 
-    if gcs_json_export_file_blob.exists():
+    if config_data.gcs_metadata_cache.blob_exists(gcs_json_export_file_blob):
 
         return True
 
     else:
         logger.debug("{} - Rerun Failed Partitions :: EXPORT FILE:: {} DOES NOT EXIST .. proceeding with creating the folder".format(config_data.table_id, gcs_json_export_file))
-        config_data.gcs_extract_status_file_blob.exists()
         gcs_json_export_folder_blob = config_data.gcs_bucket.blob(gcs_json_export_folder)
 
-        if gcs_json_export_folder_blob.exists() is False:
+        if config_data.gcs_metadata_cache.blob_exists(gcs_json_export_folder_blob) is False:
             logger.debug("{} - Rerun Failed Partitions :: EXPORT FOLDER:: {} DOES NOT EXIST .. proceeding with creating the folder".format(config_data.table_id, gcs_json_export_folder))
             create_folder_in_bucket(gcs_json_export_folder_blob)
+            config_data.gcs_metadata_cache.mark_written(gcs_json_export_folder_blob)
 
         return False
 
 
-def rerun_failed_partions_export(opts):
+def rerun_failed_partions_export(opts, partitions=None):
     global extract_status_json_data
 
     if (opts.export_start_date is None) and (opts.export_end_date is None) and ((opts.historical_run is None) or (opts.historical_run is False)):
         if extract_status_json_data is not None:
-            # Read all the records which do not have status key. Run the extract process and update the status file
-            for all_records in extract_status_json_data['extract_status']:
-                if 'status' not in all_records:
+            # Plan the whole recovery from a single partition metadata lookup and queue in one batch
+            #   1.all the records which do not have status key, if the partition still exists in the source table
+            #   2.partitions modified after their export
+            #   3.partitions whose export files do not match the bytes in the status file
+            #   4.partitions exported before committed markers were written get their committed marker
+            if partitions is None:
+                partitions = get_partition_metadata(config_data)
 
-                    failed_run = all_records
-                    export_start_date = failed_run["export_date_partition"]
+            failed_partitions = get_failed_partitions(extract_status_json_data)
+            missing_partitions = [export_date for export_date in failed_partitions if export_date not in partitions]
+            if missing_partitions:
+                logger.warning("{} - Failed Partition export: partitions not in the source table anymore, skipped: {}".format(config_data.table_id, missing_partitions))
 
-                    date = datetime.strptime(export_start_date, "%Y%m%d")
-                    end_date = date + timedelta(days=1)
-                    export_end_date = datetime.strftime(end_date, "%Y%m%d")
+            for export_date in failed_partitions:
+                if export_date in partitions:
+                    export_queue.add(export_date, "failed")
 
-                    logger.debug("{} - Failed Partition export: export_start_date: {}... export_end_date: {} ...".format(config_data.table_id, export_start_date, export_end_date))
+            logger.debug("{} - Failed Partition export: {} failed partitions queued ...".format(config_data.table_id, len(failed_partitions) - len(missing_partitions)))
 
-                    extract_billing(export_start_date, export_end_date)
+            extract_records = {record['export_date_partition']: record for record in extract_status_json_data['extract_status']}
 
-            partitions = get_all_partitions()
+            for export_date, metadata in partitions.items():
 
-            dataset_ref = get_dataset_ref(config_data)
+                if export_date in export_queue:
+                    continue
 
-            for part in partitions.result():
+                if export_date in extract_records and partition_restated(extract_records[export_date], metadata):
+                    export_queue.add(export_date, "restated")
 
-                export_date = part[0]
-                destination_uri = "gs://{}/{}/{}/{}".format(config_data.bucket_name, config_data.table_id, export_date, "billing-export-*.json")
+                elif gcs_extract_json_blob_exists(config_data, export_date) is False:
+                    export_queue.add(export_date, "mismatch")
 
-                if gcs_extract_json_blob_exists(config_data, export_date) is False:
+                elif not config_data.gcs_metadata_cache.blob_exists(config_data.gcs_bucket.blob("{}/{}/{}".format(config_data.table_id, export_date, COMMIT_MARKER))):
+                    commit_unmarked_partition(config_data, export_date, get_bytes_from_status_file(extract_status_json_data, export_date))
 
-                    extract_config = bigquery.job.ExtractJobConfig()
-                    extract_config.destination_format = bigquery.DestinationFormat.NEWLINE_DELIMITED_JSON
 
-                    status = "started"
-                    total_bytes_written = 0
+def get_partition_metadata(config_data):
+    # partition metadata query: one row per date partition with its last modification time
+    partition_query = str("""select partition_id, total_rows, total_logical_bytes, last_modified_time
+                from `{}.{}.INFORMATION_SCHEMA.PARTITIONS`
+                where table_name = "{}"
+                and partition_id not in ("__NULL__", "__UNPARTITIONED__")
+                order by partition_id asc;""").format(config_data.project, config_data.dataset_id, config_data.table_id)
+    logger.debug("\n{} - Partition Metadata Query: \n{}\n".format(config_data.table_id, partition_query))
 
-                    update_extract_status_json(status, export_date, total_bytes_written)
-                    write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
+    try:
+        rows = config_data.big_query_client.query(partition_query, location=get_source_location(config_data)).result()
+        count_api_calls()
+    except:
+        logger.error("{} - Partition Metadata Query didnot execute. Please check and try again.".format(config_data.table_id))
+        raise Exception(
+            "Partition Metadata Query didnot execute. Please check and try again.")
+
+    partition_metadata = {}
+    for row in rows:
+        partition_metadata[row[0]] = {"total_rows": row[1], "total_logical_bytes": row[2], "last_modified_time": row[3]}
+
+    # partition sizes for the split of oversized partitions, see get_sub_ranges
+    config_data.partition_metadata = partition_metadata
+
+    return partition_metadata
+
+
+def get_changed_partitions(known_partitions, partitions):
+    # new partitions and partitions modified since they were last seen, in partition order
+    return sorted(partition_id for partition_id, metadata in partitions.items()
+                  if partition_id not in known_partitions
+                  or known_partitions[partition_id]["last_modified_time"] != metadata["last_modified_time"])
+
+
+def wait_for_next_poll(poll_interval):
+    # sleep in short steps so a termination signal is acted on promptly
+    next_poll = time.time() + poll_interval
+    while not drain_requested and time.time() < next_poll:
+        time.sleep(max(0, min(1, next_poll - time.time())))
+
+
+def get_retry_time(failure, poll_interval, heal_interval):
+    # a partition failing again and again is retried after 1, 2, 4 ... poll intervals, at most heal_interval apart
+    attempts, failed_time = failure
+    return failed_time + min(poll_interval * 2 ** (attempts - 1), heal_interval)
+
+
+def run_daemon(poll_interval, heal_interval):
+    # Keep the clients and the in-memory status open and export partitions as soon as they change.
+    #   1.take a partition metadata snapshot and run the regular delta + auto healing pass
+    #   2.poll the partition metadata every poll_interval seconds
+    #   3.queue new or modified partitions, and every heal_interval seconds the auto healing pass,
+    #     export them, then save the status file and log file on gcs
+    # A partition is known once it is exported, partitions that fail to export stay changed and are retried with an
+    # exponential backoff, see get_retry_time.
+    known_partitions = get_partition_metadata(config_data)
+
+    start_extract_process()
+    for export_date in export_queue.failed:
+        known_partitions.pop(export_date, None)
+    save_status_files()
+    next_heal = time.time() + heal_interval
+
+    while not drain_requested:
+
+        with run_stats.idle():
+            wait_for_next_poll(poll_interval)
+        if drain_requested:
+            break
+
+        partitions = get_partition_metadata(config_data)
+        changed_partitions = get_changed_partitions(known_partitions, partitions)
+        logger.info("{} - Daemon poll: {} partitions, changed partitions: {}".format(config_data.table_id, len(partitions), changed_partitions))
 
-                    table_ref = dataset_ref.table(config_data.table_id + "$" + export_date)
-                    success, total_bytes_written = extract_partition(config_data, table_ref, destination_uri, extract_config, export_date)
+        for export_date in changed_partitions:
+            failure = export_queue.failed.get(export_date)
+            if failure is not None and time.time() < get_retry_time(failure, poll_interval, heal_interval):
+                logger.debug("{} - Daemon poll: partition {} failed {} times, retried later".format(config_data.table_id, export_date, failure[0]))
+                continue
+            export_queue.add(export_date, "restated" if export_date in known_partitions else "new")
 
+        healed = time.time() >= next_heal
+        if healed:
+            logger.info("{} - Daemon poll: auto healing pass".format(config_data.table_id))
+            rerun_failed_partions_export(opts, partitions)
+            next_heal = time.time() + heal_interval
 
-                    if success:
+        queued_partitions = len(export_queue)
 
-                        status = "success"
+        for export_date in run_export_queue():
+            known_partitions[export_date] = partitions[export_date]
+        for export_date in export_queue.failed:
+            known_partitions.pop(export_date, None)
 
-                        update_extract_status_json(status, export_date, total_bytes_written)
-                        write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
-                        logger.debug("{} - Export partition completed successfully for : {}\n".format(config_data.table_id, export_date))
+        if queued_partitions:
+            save_status_files()
 
+    logger.critical("{} - Daemon drained, saving local status file, gcs status file, log file ...".format(config_data.table_id))
+    if extract_status_json_data is not None:
+        write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
+    save_status_files()
+
+
+def save_status_files():
+    global run_stats
+
+    # append the run to the run history, a daemon starts a new run after every save
+    record_run_history(config_data, run_stats)
+    run_stats = RunStats(run_stats.mode, config_data.gcs_metadata_cache.misses)
+
+    if extract_status_json_data is not None:
+
+        write_to_gcs_status_file(config_data,extract_status_json_data)
+        logger.debug("{} - Extract status file is saved on gcs".format(config_data.table_id))
+
+    logger.info("{} - gcs metadata cache hits: {} , misses: {}".format(config_data.table_id, config_data.gcs_metadata_cache.hits, config_data.gcs_metadata_cache.misses))
+    upload_file_to_gcs(config_data.gcs_log_file_blob, config_data.log_file, config_data.transfer)
+    logger.debug("{} - Extract log status file is saved on gcs".format(config_data.table_id))
+
+    upload_file_to_gcs(config_data.gcs_run_history_blob, config_data.run_history_file, config_data.transfer)
+    config_data.gcs_metadata_cache.mark_written(config_data.gcs_run_history_blob)
 
 
+def append_run_history(history_file, table_id, run_stats, completed=True):
+    connection = sqlite3.connect(history_file)
+    try:
+        with connection:
+            connection.execute("""create table if not exists runs (
+                                    run_id text primary key, table_id text, mode text, completed integer,
+                                    duration_seconds real, partitions integer, failed_partitions integer,
+                                    bytes integer, api_calls integer, retries integer)""")
+            connection.execute("""create table if not exists run_phases (
+                                    run_id text, phase text, duration_seconds real, primary key (run_id, phase))""")
+            connection.execute("insert or replace into runs values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (run_stats.run_id, table_id, run_stats.mode, int(completed), run_stats.duration(),
+                                run_stats.partitions, run_stats.failed_partitions, run_stats.bytes, run_stats.api_calls, run_stats.retries))
+            connection.executemany("insert or replace into run_phases values (?, ?, ?)",
+                                   [(run_stats.run_id, phase, duration) for phase, duration in run_stats.phases.items()])
+    finally:
+        connection.close()
+
+
+def record_run_history(config_data, run_stats, completed=True):
+    # restore the run history from gcs when the local copy is lost, e.g. on a recreated VM
+    if not os.path.exists(config_data.run_history_file) and config_data.gcs_metadata_cache.blob_exists(config_data.gcs_run_history_blob):
+        config_data.transfer.download_to_filename(config_data.gcs_run_history_blob, config_data.run_history_file)
+        count_api_calls()
+
+    run_stats.api_calls += config_data.gcs_metadata_cache.misses - run_stats.gcs_metadata_misses
+    append_run_history(config_data.run_history_file, config_data.table_id, run_stats, completed)
+    logger.info("{} - Run {} ({}): {:.1f} seconds, {} partitions, {} failed, {} bytes, {} api calls, {} retries, phases: {}".format(
+        config_data.table_id, run_stats.run_id, run_stats.mode, run_stats.duration(), run_stats.partitions, run_stats.failed_partitions,
+        run_stats.bytes, run_stats.api_calls, run_stats.retries, {phase: round(duration, 1) for phase, duration in run_stats.phases.items()}))
+
+
+def read_run_history(history_file):
+    # runs of a run history in run order, with their phase durations
+    connection = sqlite3.connect(history_file)
+    connection.row_factory = sqlite3.Row
+    try:
+        runs = [dict(row) for row in connection.execute("select * from runs order by run_id")]
+        phases = {}
+        for row in connection.execute("select * from run_phases"):
+            phases.setdefault(row["run_id"], {})[row["phase"]] = row["duration_seconds"]
+    finally:
+        connection.close()
+
+    for run in runs:
+        run["phases"] = phases.get(run["run_id"], {})
+        export_seconds = sum(run["phases"].get(phase, 0) for phase in ("extract", "verify", "promote"))
+        run["export_seconds_per_gb"] = export_seconds / (run["bytes"] / 1e9) if run["bytes"] else None
+        run["verification_overhead"] = run["phases"].get("verify", 0) / export_seconds if export_seconds else None
+
+    return runs
+
+
+def percentile(values, percent):
+    # nearest-rank percentile, None without values
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def find_slow_runs(runs, baseline_runs, slowdown_threshold):
+    # runs whose export time per GB exceeds slowdown_threshold x the median of the previous baseline_runs runs
+    slow_runs = []
+    measured_runs = [run for run in runs if run["export_seconds_per_gb"] is not None]
+
+    for index, run in enumerate(measured_runs):
+        baseline = percentile([previous["export_seconds_per_gb"] for previous in measured_runs[max(0, index - baseline_runs):index]], 50)
+        if index >= 3 and run["export_seconds_per_gb"] > slowdown_threshold * baseline:
+            slow_runs.append(dict(run, baseline_seconds_per_gb=baseline))
+
+    return slow_runs
+
+
+def get_trend(runs, key, window=5):
+    # change of the mean of the last window runs against the window before, in percent
+    values = [run[key] for run in runs if run[key] is not None]
+    if len(values) < 2 * window:
+        return None
+    previous = sum(values[-2 * window:-window]) / window
+    latest = sum(values[-window:]) / window
+    return (latest - previous) / previous * 100 if previous else None
+
+
+def format_report_value(value, pattern="{:.2f}"):
+    return "-" if value is None else pattern.format(value)
+
+
+def print_run_history_report(baseline_runs, slowdown_threshold):
+    # trends, percentiles and slow runs of every table with a run history in the working directory
+    history_files = sorted(glob.glob("*/process_status/run_history.db"))
+    if not history_files:
+        print("No run history found under {}/*/process_status/".format(os.getcwd()))
+        return
+
+    summary = []
+    for history_file in history_files:
+        runs = read_run_history(history_file)
+        if not runs:
+            continue
+
+        table_id = runs[-1]["table_id"]
+        slow_runs = find_slow_runs(runs, baseline_runs, slowdown_threshold)
+        summary.append((table_id, runs, slow_runs))
+
+        print("\n== {} : {} runs ({} completed) from {} to {}".format(table_id, len(runs), sum(run["completed"] for run in runs), runs[0]["run_id"], runs[-1]["run_id"]))
+        print("{:<28} {:>12} {:>12} {:>12}".format("", "p50", "p90", "p99"))
+
+        rows = [("duration s", [run["duration_seconds"] for run in runs], "{:.1f}"),
+                ("export s/GB", [run["export_seconds_per_gb"] for run in runs], "{:.1f}"),
+                ("verification overhead %", [run["verification_overhead"] * 100 if run["verification_overhead"] is not None else None for run in runs], "{:.1f}"),
+                ("partitions", [run["partitions"] for run in runs], "{:.0f}"),
+                ("api calls", [run["api_calls"] for run in runs], "{:.0f}")]
+        for phase in sorted(set(phase for run in runs for phase in run["phases"])):
+            rows.append(("phase {} s".format(phase), [run["phases"].get(phase) for run in runs], "{:.1f}"))
+
+        for name, values, pattern in rows:
+            print("{:<28} {:>12} {:>12} {:>12}".format(name, *[format_report_value(percentile(values, percent), pattern) for percent in (50, 90, 99)]))
+
+        print("trend, last 5 runs against the 5 before: duration {}%, export s/GB {}%, verification overhead {}%".format(
+            format_report_value(get_trend(runs, "duration_seconds"), "{:+.1f}"),
+            format_report_value(get_trend(runs, "export_seconds_per_gb"), "{:+.1f}"),
+            format_report_value(get_trend(runs, "verification_overhead"), "{:+.1f}")))
+        print("totals: {} bytes, {} partitions, {} failed partitions, {} retries".format(
+            sum(run["bytes"] for run in runs), sum(run["partitions"] for run in runs),
+            sum(run["failed_partitions"] for run in runs), sum(run["retries"] for run in runs)))
+
+        if slow_runs:
+            print("runs slower than {} x the median export s/GB of the previous {} runs:".format(slowdown_threshold, baseline_runs))
+            for run in slow_runs:
+                print("    {}  {:<10} {:>10.1f} s/GB  baseline {:>10.1f} s/GB  x{:.2f}".format(
+                    run["run_id"], run["mode"], run["export_seconds_per_gb"], run["baseline_seconds_per_gb"],
+                    run["export_seconds_per_gb"] / run["baseline_seconds_per_gb"]))
+
+    print("\n== all tables")
+    print("{:<32} {:>6} {:>14} {:>14} {:>14} {:>10} {:>6}".format("table", "runs", "p50 duration s", "p50 s/GB", "latest s/GB", "trend %", "slow"))
+    for table_id, runs, slow_runs in summary:
+        measured_runs = [run for run in runs if run["export_seconds_per_gb"] is not None]
+        print("{:<32} {:>6} {:>14} {:>14} {:>14} {:>10} {:>6}".format(
+            table_id, len(runs),
+            format_report_value(percentile([run["duration_seconds"] for run in runs], 50), "{:.1f}"),
+            format_report_value(percentile([run["export_seconds_per_gb"] for run in runs], 50), "{:.1f}"),
+            format_report_value(measured_runs[-1]["export_seconds_per_gb"] if measured_runs else None, "{:.1f}"),
+            format_report_value(get_trend(runs, "export_seconds_per_gb"), "{:+.1f}"),
+            len(slow_runs)))
+
 
 def parse_args():
     """Parse argv into usable input."""
@@ -613,6 +1645,10 @@ def parse_args():
     # Instantiate the parser
     parser = argparse.ArgumentParser(description='Optional app description')
 
+    # optional positional argument
+    parser.add_argument('command', type=str, nargs='?', default='export', choices=['export', 'report'],
+                        help='export (default) runs the exporter, report prints the run history trends of the tables in the working directory')
+
     # optional positional argument
     parser.add_argument('--config_file', type=str, nargs='?',
                         help='An optional config json file to define source_project_id, source_dataset_id, source_table_id, destination_bucket')
@@ -629,18 +1665,48 @@ def parse_args():
     parser.add_argument('--historical_run', type=bool, nargs='?',
                         help='An optional boolean value for historic run')
 
+    # Optional argument
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and export partitions as soon as they change')
+
+    # Optional argument
+    parser.add_argument('--poll_interval', type=int, default=300,
+                        help='Seconds between partition metadata polls in daemon mode, default 300')
+
+    # Optional argument
+    parser.add_argument('--heal_interval', type=int, default=3600,
+                        help='Seconds between auto healing passes (failed and mismatched partitions) in daemon mode, default 3600')
+
+    # Optional argument
+    parser.add_argument('--baseline_runs', type=int, default=10,
+                        help='Report: number of previous runs in the rolling baseline, default 10')
+
+    # Optional argument
+    parser.add_argument('--slowdown_threshold', type=float, default=1.5,
+                        help='Report: flag runs slower than this multiple of the rolling baseline, default 1.5')
+
     opts = parser.parse_args()
 
     return opts
 
 
 def signal_handler(signum, frame):
+    global drain_requested
+
+    # In daemon mode the first signal drains: the partition being exported is finished, the status is saved and
+    # the daemon exits. A second signal saves the status right away and exits.
+    if opts.daemon and not drain_requested:
+        drain_requested = True
+        logger.critical('{} - got {} termination signal, draining daemon after the current partition ...'.format(config_data.table_id, signum))
+        return
 
     logger.critical('{} - got {} termination signal, saving local status file, gcs status file, log file ...'.format(config_data.table_id, signum))
 
     write_to_gcs_status_file(config_data,extract_status_json_data)
     write_to_local_status_file(config_data.extract_status_file,extract_status_json_data)
-    upload_file_to_gcs(config_data.gcs_log_file_blob, config_data.log_file)
+    record_run_history(config_data, run_stats, completed=False)
+    upload_file_to_gcs(config_data.gcs_log_file_blob, config_data.log_file, config_data.transfer)
+    upload_file_to_gcs(config_data.gcs_run_history_blob, config_data.run_history_file, config_data.transfer)
     temp_file = "{}/process_status/temp.json".format(config_data.table_id)
     if os.path.exists(temp_file): os.remove(temp_file)
 
@@ -691,23 +1757,34 @@ if __name__ == '__main__':
 
     opts = parse_args()
 
+    if opts.command == "report":
+        print_run_history_report(opts.baseline_runs, opts.slowdown_threshold)
+        sys.exit(0)
+
     exporter_config = read_exporter_config(opts)
     config_data = Config(exporter_config)
 
     if config_data.check_config():
 
+        if opts.daemon:
+            run_mode = "daemon"
+        elif opts.historical_run:
+            run_mode = "historical"
+        elif opts.export_start_date is not None:
+            run_mode = "adhoc"
+        else:
+            run_mode = "delta"
+        run_stats = RunStats(run_mode, config_data.gcs_metadata_cache.misses)
+
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
 
-        start_extract_process()
+        if opts.daemon:
+            run_daemon(opts.poll_interval, opts.heal_interval)
 
-        if extract_status_json_data is not None:
-
-            write_to_gcs_status_file(config_data,extract_status_json_data)
-            logger.debug("{} - Extract status file is saved on gcs".format(config_data.table_id))
-
-        upload_file_to_gcs(config_data.gcs_log_file_blob, config_data.log_file)
-        logger.debug("{} - Extract log status file is saved on gcs".format(config_data.table_id))
+        else:
+            start_extract_process()
+            save_status_files()
 
     else:
 
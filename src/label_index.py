@@ -0,0 +1,231 @@
+# Copyright 2019 Google LLC. This software is provided as-is, without warranty or representation
+# for any use or purpose. Your use of it is subject to your agreement with Google.
+
+# Reader for the label index sidecar written by src/export.py next to the export files of every partition:
+#
+#   gs://<bucket-name>/<table_id>/<partition date>/_label_index.json
+#
+#   {"version": 1, "export_date_partition": "20190101",
+#    "shards": {"billing-export-000000000000.json": {"rows": .., "bytes": .., "min_cost": .., "max_cost": ..,
+#                                                   "min_usage_start_time": .., "max_usage_start_time": ..}},
+#    "labels": {"<key>": {"<value>": {"billing-export-000000000000.json": [[start_row, end_row, start_byte, end_byte], ..]}}}}
+#
+# Row and byte ranges are end exclusive. Only the byte ranges of the rows carrying the label are downloaded, in reads of
+# at most READ_CHUNK_BYTES, and rows are returned as they are read.
+# Reads are pinned to the generations of the export files and of the index listed in the _COMMITTED marker. A partition
+# published again before any of its rows was returned is read again from its new marker, after that the read raises
+# PartitionPublishedAgain and the caller reads the partition again. Committed partitions without a label index
+# (exported before label indexes were written) are read by scanning their export files, downloaded to a temporary file,
+# and a partition with export files but no _COMMITTED marker raises UncommittedPartition instead of being skipped.
+#
+#   reader = LabelIndexReader("billing-bucket", "gcp_billing_export")
+#   for row in reader.read_rows("20190101", "20190201", "env", "prod"):
+#       ...
+#
+# This module does not import src/export.py, so it can be used without the exporter logging set up.
+
+import json
+import os
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+# noinspection PyUnresolvedReferences
+from google.cloud import storage
+# noinspection PyUnresolvedReferences
+from google.api_core.exceptions import NotFound
+
+COMMIT_MARKER = "_COMMITTED"
+LABEL_INDEX = "_label_index.json"
+
+# a partition published again while it is read is read again, at most this many times,
+# waiting PUBLISH_WAIT_SECONDS for a partition found without its marker
+MAX_READ_ATTEMPTS = 3
+PUBLISH_WAIT_SECONDS = 2
+
+# byte ranges are downloaded in reads of at most this size, so memory does not grow with the export files
+READ_CHUNK_BYTES = 8 * 1024 ** 2
+
+
+class UncommittedPartition(Exception):
+    pass
+
+
+class PartitionPublishedAgain(Exception):
+    pass
+
+
+def merge_ranges(ranges):
+    # merge overlapping or adjacent [start_row, end_row, start_byte, end_byte] ranges of a shard
+    merged = []
+    for start_row, end_row, start_byte, end_byte in sorted(ranges):
+        if merged and merged[-1][1] >= start_row:
+            merged[-1][1] = max(merged[-1][1], end_row)
+            merged[-1][3] = max(merged[-1][3], end_byte)
+        else:
+            merged.append([start_row, end_row, start_byte, end_byte])
+    return merged
+
+
+def row_has_label(row, key, value=None):
+    return any(label["key"] == key and (value is None or label["value"] == value) for label in row.get("labels") or [])
+
+
+def row_in_usage_range(row, usage_start_time_from=None, usage_start_time_to=None):
+    if usage_start_time_from is not None and row.get("usage_start_time") is not None and row["usage_start_time"] < usage_start_time_from:
+        return False
+    if usage_start_time_to is not None and row.get("usage_start_time") is not None and row["usage_start_time"] >= usage_start_time_to:
+        return False
+    return True
+
+
+def shard_in_usage_range(shard, usage_start_time_from=None, usage_start_time_to=None):
+    # usage_start_time bounds are strings in the export format, e.g. "2019-01-01 05:00:00 UTC"
+    if usage_start_time_from is not None and shard["max_usage_start_time"] is not None and shard["max_usage_start_time"] < usage_start_time_from:
+        return False
+    if usage_start_time_to is not None and shard["min_usage_start_time"] is not None and shard["min_usage_start_time"] >= usage_start_time_to:
+        return False
+    return True
+
+
+def read_lines(blob, start_byte, end_byte):
+    # lines of the byte range of a blob, downloaded in READ_CHUNK_BYTES reads
+    remainder = b""
+    for chunk_start in range(start_byte, end_byte, READ_CHUNK_BYTES):
+        # GCS byte ranges are end inclusive
+        lines = (remainder + blob.download_as_string(start=chunk_start, end=min(chunk_start + READ_CHUNK_BYTES, end_byte) - 1)).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if remainder:
+        yield remainder
+
+
+class LabelIndexReader:
+
+    def __init__(self, bucket_name, table_id, storage_client=None):
+        """
+        Read the rows of exported partitions carrying a label, using the label index sidecars
+        """
+        self.storage_client = storage_client if storage_client is not None else storage.Client()
+        self.bucket = self.storage_client.bucket(bucket_name)
+        self.table_id = table_id
+        self.commit_markers = {}
+        self.indexes = {}
+
+    def get_commit_marker(self, export_date):
+        # committed marker of a partition, None if the partition is not committed
+        if export_date not in self.commit_markers:
+            try:
+                self.commit_markers[export_date] = json.loads(self.bucket.blob("{}/{}/{}".format(self.table_id, export_date, COMMIT_MARKER)).download_as_string())
+            except NotFound:
+                self.commit_markers[export_date] = None
+
+        return self.commit_markers[export_date]
+
+    def get_index(self, export_date):
+        # label index of a committed partition, None if the partition is not committed or has no index
+        if export_date not in self.indexes:
+            commit_marker = self.get_commit_marker(export_date)
+            if commit_marker is None or commit_marker.get("label_index") is None:
+                self.indexes[export_date] = None
+            else:
+                index_blob = self.bucket.blob("{}/{}/{}".format(self.table_id, export_date, commit_marker["label_index"]),
+                                              generation=commit_marker.get("label_index_generation"))
+                self.indexes[export_date] = json.loads(index_blob.download_as_string())
+
+        return self.indexes[export_date]
+
+    def forget(self, export_date):
+        self.commit_markers.pop(export_date, None)
+        self.indexes.pop(export_date, None)
+
+    def find(self, export_date, key, value=None, usage_start_time_from=None, usage_start_time_to=None):
+        # {shard: ranges} of the rows carrying label key (with the given value), in shards overlapping the usage range
+        index = self.get_index(export_date)
+        if index is None:
+            return {}
+
+        postings = {}
+        for label_value, shards in index["labels"].get(key, {}).items():
+            if value is not None and label_value != value:
+                continue
+            for shard_name, ranges in shards.items():
+                if shard_in_usage_range(index["shards"][shard_name], usage_start_time_from, usage_start_time_to):
+                    postings.setdefault(shard_name, []).extend(ranges)
+
+        return {shard_name: merge_ranges(ranges) for shard_name, ranges in postings.items()}
+
+    def get_shard_blob(self, export_date, shard_name):
+        commit_marker = self.get_commit_marker(export_date)
+        return self.bucket.blob("{}/{}/{}".format(self.table_id, export_date, shard_name),
+                                generation=commit_marker.get("generations", {}).get(shard_name))
+
+    def scan_partition(self, export_date, key, value=None, usage_start_time_from=None, usage_start_time_to=None):
+        # rows carrying the label in a committed partition without label index, read from all its export files
+        for shard_name in self.get_commit_marker(export_date)["shards"]:
+            handle, shard_file = tempfile.mkstemp(suffix=".json")
+            os.close(handle)
+            try:
+                self.get_shard_blob(export_date, shard_name).download_to_filename(shard_file)
+                with open(shard_file, "rb") as f:
+                    for line in f:
+                        row = json.loads(line)
+                        if row_has_label(row, key, value) and row_in_usage_range(row, usage_start_time_from, usage_start_time_to):
+                            yield row
+            finally:
+                os.remove(shard_file)
+
+    def read_ranges(self, export_date, key, value=None, usage_start_time_from=None, usage_start_time_to=None):
+        for shard_name, ranges in sorted(self.find(export_date, key, value, usage_start_time_from, usage_start_time_to).items()):
+            blob = self.get_shard_blob(export_date, shard_name)
+            for start_row, end_row, start_byte, end_byte in ranges:
+                for line in read_lines(blob, start_byte, end_byte):
+                    row = json.loads(line)
+                    if row_in_usage_range(row, usage_start_time_from, usage_start_time_to):
+                        yield row
+
+    def read_partition(self, export_date, key, value=None, usage_start_time_from=None, usage_start_time_to=None):
+        # rows are returned as they are read. A partition published again during the read (the pinned generations
+        # are gone) is read again from its new marker as long as none of its rows was returned, without duplicates
+        for attempt in range(MAX_READ_ATTEMPTS):
+            commit_marker = self.get_commit_marker(export_date)
+
+            if commit_marker is None:
+                partition_prefix = "{}/{}/".format(self.table_id, export_date)
+                if not any(blob.name.startswith(partition_prefix + "billing-export-") for blob in self.bucket.list_blobs(prefix=partition_prefix)):
+                    return
+                # export files without marker: the partition is being published, or was never committed
+                self.forget(export_date)
+                time.sleep(PUBLISH_WAIT_SECONDS)
+                continue
+
+            if commit_marker.get("label_index") is None:
+                rows = self.scan_partition(export_date, key, value, usage_start_time_from, usage_start_time_to)
+            else:
+                rows = self.read_ranges(export_date, key, value, usage_start_time_from, usage_start_time_to)
+
+            rows_returned = 0
+            try:
+                for row in rows:
+                    yield row
+                    rows_returned += 1
+                return
+            except NotFound:
+                self.forget(export_date)
+                if rows_returned:
+                    raise PartitionPublishedAgain("Partition {} was published again after {} of its rows were read".format(export_date, rows_returned))
+
+        if self.get_commit_marker(export_date) is None:
+            raise UncommittedPartition("{}/{}/ has export files but no {} marker".format(self.table_id, export_date, COMMIT_MARKER))
+        raise PartitionPublishedAgain("Partition {} was published again during {} read attempts".format(export_date, MAX_READ_ATTEMPTS))
+
+    def read_rows(self, start_date, end_date, key, value=None, usage_start_time_from=None, usage_start_time_to=None):
+        # rows carrying the label in the partitions from start_date to end_date (exclusive), format yyyymmdd
+        date = datetime.strptime(start_date, "%Y%m%d")
+        while date < datetime.strptime(end_date, "%Y%m%d"):
+            for row in self.read_partition(datetime.strftime(date, "%Y%m%d"), key, value, usage_start_time_from, usage_start_time_to):
+                yield row
+            date = date + timedelta(days=1)
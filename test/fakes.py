@@ -0,0 +1,530 @@
+############ DISCLAIMER ####################
+# Copyright 2019 Google LLC. This software is provided as-is, without warranty or representation
+# for any use or purpose. Your use of it is subject to your agreement with Google.
+############################################
+
+# Local stand-ins for the BigQuery, Cloud Storage and Cloud Logging clients used by src/export.py.
+# State lives in a work directory, so it survives across exporter processes:
+#
+#   <root>/gcs/<bucket>/<quoted object name>   objects of the fake bucket
+#   <root>/bigquery.json                       source table location and date partitions
+#   <root>/ledger.jsonl                        one line per API call, tagged with FAKE_RUN_ID
+#
+# FAKE_LATENCY adds a delay to every API call, FAKE_STREAM_BANDWIDTH (bytes per second) caps every upload and download
+# request to one stream of that bandwidth.
+# FAKE_FAULT_POINT=<function>:<event>:<n> and FAKE_FAULT_MODE=sigterm|kill make the n-th <event>
+# ("query", "extract", "download", "upload") issued from inside <function> preempt the process.
+
+import json
+import logging
+import os
+import random
+import re
+import signal
+import sys
+import time
+import types
+
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, unquote
+
+ROWS_PER_SHARD = 400
+
+fault_counter = 0
+
+# calls inside a batch are sent as one request, the batch pays the latency
+batch_depth = 0
+batch_requests = 0
+
+
+def root_dir():
+    return os.environ["FAKE_ROOT"]
+
+
+def record(call, **kwargs):
+    # every API call costs FAKE_LATENCY seconds
+    global batch_requests
+    if not batch_depth:
+        time.sleep(float(os.environ.get("FAKE_LATENCY", 0)))
+    else:
+        batch_requests += 1
+    entry = {"run": os.environ.get("FAKE_RUN_ID", "0"), "call": call}
+    entry.update(kwargs)
+    with open(os.path.join(root_dir(), "ledger.jsonl"), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def throttle_stream(size):
+    bandwidth = float(os.environ.get("FAKE_STREAM_BANDWIDTH", 0))
+    if bandwidth:
+        time.sleep(size / bandwidth)
+
+
+def read_ledger(root):
+    path = os.path.join(root, "ledger.jsonl")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def maybe_inject_fault(event):
+    global fault_counter
+
+    fault_point = os.environ.get("FAKE_FAULT_POINT")
+    if not fault_point:
+        return
+
+    function_name, fault_event, n = fault_point.split(":")
+    if fault_event != event:
+        return
+
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_name != function_name:
+        frame = frame.f_back
+    if frame is None:
+        return
+
+    fault_counter += 1
+    if fault_counter == int(n):
+        record("fault", point=fault_point)
+        mode = os.environ.get("FAKE_FAULT_MODE", "sigterm")
+        os.kill(os.getpid(), signal.SIGKILL if mode == "kill" else signal.SIGTERM)
+
+
+class NotFound(Exception):
+    pass
+
+
+# Cloud Storage
+
+def write_object(path, data):
+    # the generation of an object is the mtime of its file, set to a fresh timestamp on every write
+    with open(path, "wb") as f:
+        f.write(data)
+    generation = time.time_ns()
+    os.utime(path, ns=(generation, generation))
+    return generation
+
+
+class FakeBlob:
+
+    def __init__(self, name, bucket, generation=None):
+        self.name = name
+        self.bucket = bucket
+        self.size = None
+        self.content_type = None
+        # set: reads are pinned to this generation of the object
+        self.generation = generation
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.path, quote(self.name, safe=""))
+
+    def load_metadata(self):
+        self.size = os.path.getsize(self.path)
+        self.generation = os.stat(self.path).st_mtime_ns
+        return self
+
+    def exists(self):
+        record("exists", name=self.name)
+        return os.path.exists(self.path)
+
+    def reload(self):
+        record("reload", name=self.name)
+        if not os.path.exists(self.path):
+            raise NotFound(self.name)
+        self.load_metadata()
+
+    def upload_from_string(self, data, content_type=None):
+        maybe_inject_fault("upload")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        throttle_stream(len(data))
+        self.generation = write_object(self.path, data)
+        self.size = len(data)
+        record("upload", name=self.name, bytes=len(data))
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, "rb") as f:
+            self.upload_from_string(f.read())
+
+    def download_as_string(self, client=None, start=None, end=None):
+        maybe_inject_fault("download")
+        if not os.path.exists(self.path):
+            raise NotFound(self.name)
+        if self.generation is not None and os.stat(self.path).st_mtime_ns != self.generation:
+            raise NotFound("{}#{}".format(self.name, self.generation))
+        with open(self.path, "rb") as f:
+            f.seek(start or 0)
+            data = f.read() if end is None else f.read(end - (start or 0) + 1)
+        throttle_stream(len(data))
+        record("download", name=self.name, bytes=len(data))
+        return data
+
+    def download_to_filename(self, filename, client=None, start=None, end=None):
+        data = self.download_as_string(start=start, end=end)
+        with open(filename, "wb") as f:
+            f.write(data)
+
+    def delete(self):
+        record("delete", name=self.name)
+        if not os.path.exists(self.path):
+            raise NotFound(self.name)
+        os.remove(self.path)
+
+    def compose(self, sources, client=None):
+        if len(sources) > 32:
+            raise ValueError("compose takes at most 32 components")
+        data = b"".join(open(source.path, "rb").read() for source in sources)
+        self.generation = write_object(self.path, data)
+        self.size = len(data)
+        record("compose", name=self.name, bytes=len(data), components=len(sources))
+
+
+class FakeBucket:
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.path = os.path.join(root_dir(), "gcs", name)
+        self.location = "US"
+        location_file = os.path.join(root_dir(), "gcs", "{}.location".format(name))
+        if os.path.exists(location_file):
+            with open(location_file) as f:
+                self.location = f.read().strip()
+
+    def blob(self, name, generation=None):
+        return FakeBlob(name, self, generation)
+
+    def get_blob(self, name):
+        blob = FakeBlob(name, self)
+        if not os.path.exists(blob.path):
+            return None
+        return blob.load_metadata()
+
+    def list_blobs(self, prefix=None, delimiter=None):
+        record("list", prefix=prefix)
+        blobs = []
+        for quoted_name in sorted(os.listdir(self.path)):
+            name = unquote(quoted_name)
+            if prefix is None or name.startswith(prefix):
+                blobs.append(FakeBlob(name, self).load_metadata())
+        return iter(blobs)
+
+    def copy_blob(self, blob, destination_bucket, new_name=None, client=None):
+        new_blob = FakeBlob(new_name or blob.name, destination_bucket)
+        with open(blob.path, "rb") as fin:
+            data = fin.read()
+        new_blob.generation = write_object(new_blob.path, data)
+        new_blob.size = len(data)
+        record("copy", name=blob.name, destination=new_blob.name)
+        return new_blob
+
+    def delete_blob(self, blob_name, client=None):
+        self.blob(blob_name).delete()
+
+
+class FakeBatch:
+
+    def __enter__(self):
+        global batch_depth, batch_requests
+        batch_depth += 1
+        batch_requests = 0
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global batch_depth
+        batch_depth -= 1
+        if exc_type is None:
+            # as google-cloud-storage, a batch without requests raises
+            if not batch_requests:
+                raise ValueError("No deferred requests")
+            record("batch")
+
+
+class FakeStorageClient:
+
+    def __init__(self, project=None):
+        self.project = project
+
+    def get_bucket(self, bucket_name):
+        record("get_bucket", bucket=bucket_name)
+        if not os.path.isdir(os.path.join(root_dir(), "gcs", bucket_name)):
+            raise NotFound(bucket_name)
+        return FakeBucket(bucket_name, self)
+
+    def lookup_bucket(self, bucket_name):
+        try:
+            return self.get_bucket(bucket_name)
+        except NotFound:
+            return None
+
+    def bucket(self, bucket_name):
+        return FakeBucket(bucket_name, self)
+
+    def batch(self):
+        return FakeBatch()
+
+
+# BigQuery
+
+def load_state(root):
+    with open(os.path.join(root, "bigquery.json")) as f:
+        return json.load(f)
+
+
+def load_bigquery_state():
+    return load_state(root_dir())
+
+
+def save_bigquery_state(root, state):
+    with open(os.path.join(root, "bigquery.json"), "w") as f:
+        json.dump(state, f, indent=4)
+
+
+def partition_rows(partition, spec):
+    rng = random.Random("{}-{}".format(partition, spec.get("version", 0)))
+    day = datetime.strptime(partition, "%Y%m%d")
+    rows = []
+    for i in range(spec["rows"]):
+        usage_start_time = day + timedelta(hours=rng.randrange(24), minutes=rng.randrange(60))
+        labels = [{"key": "env", "value": rng.choice(["prod", "dev", "test"])}]
+        if rng.random() < 0.5:
+            labels.append({"key": "team", "value": rng.choice(["billing", "data", "web", "ml"])})
+        rows.append({
+            "billing_account_id": "000000-000000-000000",
+            "service": {"id": "6F81-5844-456A", "description": rng.choice(["Compute Engine", "BigQuery", "Cloud Storage"])},
+            "usage_start_time": usage_start_time.strftime("%Y-%m-%d %H:%M:%S UTC"),
+            "usage_end_time": (usage_start_time + timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S UTC"),
+            "project": {"id": "project-{}".format(rng.randrange(5))},
+            "labels": labels,
+            "cost": round(rng.random() * 10, 6),
+            "currency": "USD",
+            "row": i,
+        })
+    return rows
+
+
+def last_modified_time(partition, spec):
+    if "last_modified" in spec:
+        return datetime.strptime(spec["last_modified"], "%Y%m%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    return (datetime.strptime(partition, "%Y%m%d") + timedelta(days=1)).replace(tzinfo=timezone.utc)
+
+
+class FakeRow(tuple):
+
+    def __new__(cls, values, fields):
+        row = super().__new__(cls, values)
+        row.fields = fields
+        return row
+
+    def __getattr__(self, name):
+        if name in self.fields:
+            return self[self.fields.index(name)]
+        raise AttributeError(name)
+
+    def get(self, name, default=None):
+        return self[self.fields.index(name)] if name in self.fields else default
+
+
+class FakeJob:
+
+    def __init__(self, run):
+        self.run = run
+        self.done = False
+        self.rows = None
+
+    def result(self):
+        if not self.done:
+            self.rows = self.run()
+            self.done = True
+        return self.rows
+
+
+class FakeTableRef:
+
+    def __init__(self, project, dataset_id, table_id):
+        self.project = project
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+
+
+class FakeDatasetRef:
+
+    def __init__(self, dataset_id, project):
+        self.dataset_id = dataset_id
+        self.project = project
+
+    def table(self, table_id):
+        return FakeTableRef(self.project, self.dataset_id, table_id)
+
+
+class FakeTable:
+
+    def __init__(self, num_rows):
+        self.num_rows = num_rows
+
+
+class FakeDataset:
+
+    def __init__(self, location):
+        self.location = location
+
+
+class FakeBigQueryClient:
+
+    def __init__(self, project=None):
+        self.project = project
+
+    def dataset(self, dataset_id, project=None):
+        return FakeDatasetRef(dataset_id, project)
+
+    def get_dataset(self, dataset_ref):
+        record("get_dataset")
+        return FakeDataset(load_bigquery_state().get("location", "US"))
+
+    def get_table(self, table_ref):
+        record("get_table", table=table_ref.table_id)
+        partition = table_ref.table_id.split("$")[1]
+        return FakeTable(load_bigquery_state()["partitions"][partition]["rows"])
+
+    def query(self, query, location=None, job_config=None):
+        maybe_inject_fault("query")
+        record("query", location=location)
+        state = load_bigquery_state()
+        partitions = state["partitions"]
+
+        if "INFORMATION_SCHEMA.PARTITIONS" in query:
+            fields = ["partition_id", "total_rows", "total_logical_bytes", "last_modified_time"]
+
+            def run():
+                return [FakeRow((part, spec["rows"], spec["rows"] * 360, last_modified_time(part, spec)), fields)
+                        for part, spec in sorted(partitions.items())]
+            return FakeJob(run)
+
+        if query.lstrip().upper().startswith("EXPORT DATA"):
+            return FakeJob(lambda: self.export_data(query, state))
+
+        bounds = re.findall(r'([<>]=?) "(\d{8})"', query)
+
+        def run():
+            selected = sorted(partitions)
+            for operator, bound in bounds:
+                if operator == ">=":
+                    selected = [p for p in selected if p >= bound]
+                elif operator == "<":
+                    selected = [p for p in selected if p < bound]
+            return [FakeRow((part,), ["parts"]) for part in selected]
+        return FakeJob(run)
+
+    def write_shards(self, destination_uri, rows, partition):
+        bucket_name, path = destination_uri[len("gs://"):].split("/", 1)
+        bucket = FakeBucket(bucket_name, self)
+        total_bytes = 0
+        for shard, start in enumerate(range(0, max(len(rows), 1), ROWS_PER_SHARD)):
+            blob = bucket.blob(path.replace("*", "{:012d}".format(shard)))
+            data = "".join(json.dumps(row) + "\n" for row in rows[start:start + ROWS_PER_SHARD]).encode("utf-8")
+            write_object(blob.path, data)
+            total_bytes += len(data)
+        record("extract", partition=partition, bytes=total_bytes, uri=destination_uri)
+
+    def extract_table(self, table_ref, destination_uri, job_config=None, location=None):
+        record("extract_job", table=table_ref.table_id, location=location)
+        partition = table_ref.table_id.split("$")[1]
+
+        def run():
+            maybe_inject_fault("extract")
+            spec = load_bigquery_state()["partitions"][partition]
+            self.write_shards(destination_uri, partition_rows(partition, spec), partition)
+        return FakeJob(run)
+
+    def export_data(self, query, state):
+        maybe_inject_fault("extract")
+        uri = re.search(r"uri\s*=\s*'([^']+)'", query).group(1)
+        partition = re.search(r'_PARTITIONDATE\s*=\s*PARSE_DATE\(\'%Y%m%d\',\s*"(\d{8})"\)', query).group(1)
+        rows = partition_rows(partition, state["partitions"][partition])
+
+        hour = re.search(r"EXTRACT\(HOUR FROM usage_start_time\), 0\) = (\d+)", query)
+        if hour:
+            rows = [row for row in rows if int(row["usage_start_time"][11:13]) == int(hour.group(1))]
+        bucket = re.search(r"MOD\(ABS\(FARM_FINGERPRINT\(TO_JSON_STRING\(t\)\)\), (\d+)\) = (\d+)", query)
+        if bucket:
+            rows = [row for row in rows if row["row"] % int(bucket.group(1)) == int(bucket.group(2))]
+
+        self.write_shards(uri, rows, partition)
+        return []
+
+
+# Module installation
+
+class FakeLoggingClient:
+
+    def __init__(self, project=None):
+        self.project = project
+
+
+class FakeCloudLoggingHandler(logging.NullHandler):
+
+    def __init__(self, client, name=None):
+        super().__init__()
+
+
+def install():
+    """
+    Register the fakes as google.cloud.{storage,bigquery,logging} in sys.modules
+    """
+    google = types.ModuleType("google")
+    cloud = types.ModuleType("google.cloud")
+    google.cloud = cloud
+
+    storage = types.ModuleType("google.cloud.storage")
+    storage.Client = FakeStorageClient
+    storage.Blob = FakeBlob
+    storage.Bucket = FakeBucket
+
+    bigquery = types.ModuleType("google.cloud.bigquery")
+    bigquery.Client = FakeBigQueryClient
+    bigquery.job = types.SimpleNamespace(ExtractJobConfig=lambda: types.SimpleNamespace(destination_format=None),
+                                         QueryJobConfig=lambda: types.SimpleNamespace())
+    bigquery.DestinationFormat = types.SimpleNamespace(NEWLINE_DELIMITED_JSON="NEWLINE_DELIMITED_JSON")
+
+    cloud_logging = types.ModuleType("google.cloud.logging")
+    cloud_logging.Client = FakeLoggingClient
+    handlers = types.ModuleType("google.cloud.logging.handlers")
+    handlers.CloudLoggingHandler = FakeCloudLoggingHandler
+    cloud_logging.handlers = handlers
+
+    api_core = types.ModuleType("google.api_core")
+    exceptions = types.ModuleType("google.api_core.exceptions")
+    exceptions.NotFound = NotFound
+    api_core.exceptions = exceptions
+
+    cloud.storage = storage
+    cloud.bigquery = bigquery
+    cloud.logging = cloud_logging
+    google.api_core = api_core
+
+    sys.modules.update({
+        "google": google,
+        "google.cloud": cloud,
+        "google.cloud.storage": storage,
+        "google.cloud.bigquery": bigquery,
+        "google.cloud.logging": cloud_logging,
+        "google.cloud.logging.handlers": handlers,
+        "google.api_core": api_core,
+        "google.api_core.exceptions": exceptions,
+    })
+
+
+def create_backends(root, bucket_name, partitions, location="US", bucket_location="US"):
+    """
+    Create an empty fake bucket and a source table with the given {partition: rows} counts
+    """
+    os.makedirs(os.path.join(root, "gcs", bucket_name), exist_ok=True)
+    with open(os.path.join(root, "gcs", "{}.location".format(bucket_name)), "w") as f:
+        f.write(bucket_location)
+    save_bigquery_state(root, {
+        "location": location,
+        "partitions": {part: {"rows": rows} for part, rows in partitions.items()},
+    })
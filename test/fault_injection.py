@@ -0,0 +1,244 @@
+############ DISCLAIMER ####################
+# Copyright 2019 Google LLC. This software is provided as-is, without warranty or representation
+# for any use or purpose. Your use of it is subject to your agreement with Google.
+############################################
+
+# Fault-injection harness measuring how much work a preemption costs the exporter.
+#
+# Every scenario runs src/export.py in child processes against the local fakes in test/fakes.py:
+#   1. setup   - a clean run exports the history partitions, then some of them are damaged
+#                (status records left "started", export files removed) as a previous preemption would
+#   2. fault   - new partitions are added and the exporter is run with SIGTERM or a hard kill injected
+#                at <function>:<event>:<n>, e.g. the 3rd extract job issued from run_export_queue
+#   3. restart - the exporter is run again without faults until it completes
+#
+# For each scenario the harness reports the time to recover (duration of the restart run), the partitions
+# exported more than once, the bytes transferred again for partitions already exported before the fault, the
+# BigQuery queries of the restart run and whether the status file and the bucket are consistent at the end.
+#
+#   $ python3 test/fault_injection.py
+#   $ python3 test/fault_injection.py --point run_export_queue:extract:3 --mode kill --output results.json
+
+import argparse
+import json
+import os
+import re
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes
+
+EXPORT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "export.py")
+
+BUCKET_NAME = "billing-export-fault-injection"
+TABLE_ID = "gcp_billing_export"
+
+DEFAULT_POINTS = [
+    "run_export_queue:extract:3",
+    "run_export_queue:download:4",
+    "run_export_queue:extract:8",
+    "rerun_failed_partions_export:query:1",
+]
+
+
+def partition_dates(count, first_date="20190101"):
+    first = datetime.strptime(first_date, "%Y%m%d")
+    return [datetime.strftime(first + timedelta(days=day), "%Y%m%d") for day in range(count)]
+
+
+def run_exporter(workdir, run_id, fault_point=None, fault_mode=None, latency=0.0):
+    env = dict(os.environ, FAKE_ROOT=workdir, FAKE_RUN_ID=run_id, FAKE_LATENCY=str(latency))
+    env.pop("FAKE_FAULT_POINT", None)
+    if fault_point is not None:
+        env.update(FAKE_FAULT_POINT=fault_point, FAKE_FAULT_MODE=fault_mode)
+
+    started = time.time()
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", workdir],
+                             cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    duration = time.time() - started
+
+    if fault_point is None and process.returncode != 0:
+        raise Exception("exporter run {} failed: {}".format(run_id, process.stderr.decode("utf-8")[-2000:]))
+
+    return duration, process.returncode
+
+
+def child(workdir):
+    fakes.install()
+    os.chdir(workdir)
+    sys.argv = [EXPORT_SCRIPT, "--config_file", "exporter_config.json"]
+    runpy.run_path(EXPORT_SCRIPT, run_name="__main__")
+
+
+def read_status_file(workdir):
+    with open(os.path.join(workdir, TABLE_ID, "process_status", "extract_status_file.json")) as f:
+        return json.load(f)
+
+
+def damage_history(workdir, history, damaged):
+    # leave the newest damaged partitions "started" and remove the export files of the oldest ones
+    status_file = os.path.join(workdir, TABLE_ID, "process_status", "extract_status_file.json")
+    status = read_status_file(workdir)
+    started = set(history[-damaged:])
+    for record in status["extract_status"]:
+        if record["export_date_partition"] in started:
+            record.pop("status", None)
+            record.pop("bytes", None)
+    with open(status_file, "w") as f:
+        json.dump(status, f, indent=4)
+
+    bucket_dir = os.path.join(workdir, "gcs", BUCKET_NAME)
+    for partition in history[:damaged]:
+        prefix = fakes.quote("{}/{}/".format(TABLE_ID, partition), safe="")
+        for name in os.listdir(bucket_dir):
+            if name.startswith(prefix):
+                os.remove(os.path.join(bucket_dir, name))
+
+
+def prepare(workdir, partitions, rows, damaged, latency):
+    history, delta = partitions[:len(partitions) // 2], partitions[len(partitions) // 2:]
+
+    fakes.create_backends(workdir, BUCKET_NAME, {partition: rows for partition in history})
+    with open(os.path.join(workdir, "exporter_config.json"), "w") as f:
+        json.dump({"source_project_id": "fault-injection", "source_dataset_id": "billing",
+                   "source_table_id": TABLE_ID, "destination_bucket": BUCKET_NAME, "logger": []}, f)
+
+    run_exporter(workdir, "setup", latency=latency)
+    damage_history(workdir, history, damaged)
+
+    state = fakes.load_state(workdir)
+    for partition in delta:
+        state["partitions"][partition] = {"rows": rows}
+    fakes.save_bigquery_state(workdir, state)
+
+
+def partition_of(entry):
+    match = re.search(r"/(\d{8})/", entry.get("name", "") + entry.get("uri", ""))
+    return entry.get("partition") or (match.group(1) if match else None)
+
+
+def is_consistent(workdir, partitions):
+    # every partition is exported, its committed marker lists exactly the export files in the partition folder
+    # and their bytes match the status file
+    status = {record["export_date_partition"]: record for record in read_status_file(workdir)["extract_status"]}
+    bucket_dir = os.path.join(workdir, "gcs", BUCKET_NAME)
+    names = [fakes.unquote(name) for name in os.listdir(bucket_dir)]
+    for partition in partitions:
+        record = status.get(partition)
+        if record is None or record.get("status") != "success":
+            return False
+        prefix = "{}/{}/".format(TABLE_ID, partition)
+        shards = sorted(name for name in names if name.startswith(prefix + "billing-export-"))
+        if prefix + "_COMMITTED" not in names:
+            return False
+        with open(os.path.join(bucket_dir, fakes.quote(prefix + "_COMMITTED", safe=""))) as f:
+            if sorted(prefix + shard for shard in json.load(f)["shards"]) != shards:
+                return False
+        written = sum(os.path.getsize(os.path.join(bucket_dir, fakes.quote(name, safe=""))) for name in shards)
+        if written != record["bytes"]:
+            return False
+    return True
+
+
+def measure(ledger, run_ids):
+    exported = {}
+    for entry in ledger:
+        if entry["run"] in run_ids and entry["call"] == "extract":
+            exported.setdefault(entry["partition"], []).append(entry["run"])
+    return exported
+
+
+def run_scenario(workdir, partitions, rows, damaged, latency, fault_point=None, fault_mode=None):
+    prepare(workdir, partitions, rows, damaged, latency)
+
+    if fault_point is None:
+        duration, _ = run_exporter(workdir, "clean", latency=latency)
+        ledger = fakes.read_ledger(workdir)
+        return {"point": "none", "mode": "none", "fault_fired": False, "fault_run_seconds": 0.0,
+                "recovery_seconds": round(duration, 3), "partitions_exported_twice": [], "bytes_transferred_again": 0,
+                "extract_jobs": sum(1 for entry in ledger if entry["run"] == "clean" and entry["call"] == "extract"),
+                "recovery_queries": sum(1 for entry in ledger if entry["run"] == "clean" and entry["call"] == "query"),
+                "consistent": is_consistent(workdir, partitions)}
+
+    fault_duration, _ = run_exporter(workdir, "fault", fault_point, fault_mode, latency)
+    recovery_duration, _ = run_exporter(workdir, "restart", latency=latency)
+
+    ledger = fakes.read_ledger(workdir)
+    exported = measure(ledger, ("fault", "restart"))
+    exported_before_fault = set(partition for partition, runs in exported.items() if "fault" in runs)
+
+    bytes_transferred_again = 0
+    for entry in ledger:
+        if entry["run"] == "restart" and entry["call"] in ("extract", "download") and partition_of(entry) in exported_before_fault:
+            bytes_transferred_again += entry.get("bytes", 0)
+
+    return {"point": fault_point, "mode": fault_mode,
+            "fault_fired": any(entry["call"] == "fault" for entry in ledger),
+            "fault_run_seconds": round(fault_duration, 3),
+            "recovery_seconds": round(recovery_duration, 3),
+            "partitions_exported_twice": sorted(partition for partition, runs in exported.items() if len(runs) > 1),
+            "bytes_transferred_again": bytes_transferred_again,
+            "extract_jobs": sum(len(runs) for runs in exported.values()),
+            "recovery_queries": sum(1 for entry in ledger if entry["run"] == "restart" and entry["call"] == "query"),
+            "consistent": is_consistent(workdir, partitions)}
+
+
+def print_results(results):
+    print("{:<42} {:<8} {:>6} {:>10} {:>10} {:>8} {:>12} {:>8} {:>8} {:>11}".format(
+        "fault point", "mode", "fired", "fault s", "recover s", "twice", "bytes again", "extracts", "queries", "consistent"))
+    for result in results:
+        print("{:<42} {:<8} {:>6} {:>10} {:>10} {:>8} {:>12} {:>8} {:>8} {:>11}".format(
+            result["point"], result["mode"], str(result["fault_fired"]), result["fault_run_seconds"], result["recovery_seconds"],
+            len(result["partitions_exported_twice"]), result["bytes_transferred_again"], result["extract_jobs"],
+            result["recovery_queries"], str(result["consistent"])))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure preemption recovery of the billing exporter against local fakes')
+    parser.add_argument('--point', type=str, action='append',
+                        help='Fault point <function>:<event>:<n>, event is one of query, extract, download, upload. Repeatable')
+    parser.add_argument('--mode', type=str, choices=['sigterm', 'kill', 'both'], default='both',
+                        help='Inject SIGTERM (graceful handler) or SIGKILL (hard kill), default both')
+    parser.add_argument('--partitions', type=int, default=12, help='Number of date partitions, default 12')
+    parser.add_argument('--rows', type=int, default=900, help='Rows per date partition, default 900')
+    parser.add_argument('--damaged', type=int, default=2,
+                        help='History partitions left "started" and history partitions with missing exports, default 2')
+    parser.add_argument('--latency', type=float, default=0.005, help='Seconds added to every fake API call, default 0.005')
+    parser.add_argument('--output', type=str, help='Write the results as json to this file')
+    parser.add_argument('--child', type=str, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    opts = parse_args()
+
+    if opts.child is not None:
+        child(opts.child)
+        sys.exit(0)
+
+    partitions = partition_dates(opts.partitions)
+    modes = ["sigterm", "kill"] if opts.mode == "both" else [opts.mode]
+    scenarios = [(None, None)] + [(point, mode) for point in (opts.point or DEFAULT_POINTS) for mode in modes]
+
+    results = []
+    for fault_point, fault_mode in scenarios:
+        workdir = tempfile.mkdtemp(prefix="billing-export-fault-")
+        try:
+            results.append(run_scenario(workdir, partitions, opts.rows, opts.damaged, opts.latency, fault_point, fault_mode))
+        finally:
+            shutil.rmtree(workdir)
+
+    print_results(results)
+
+    if opts.output is not None:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -132,3 +132,310 @@ def test_upload_file_to_gcs(config_data):
     # Clean up
     blob.delete()
     print("log file deleted ...")
+
+
+def test_gcs_metadata_cache(config_data):
+    cache = config_data.gcs_metadata_cache
+    test_file = "process_status/test_cache.json"
+    blob = config_data.gcs_bucket.blob(test_file)
+
+    misses = cache.misses
+    hits = cache.hits
+    exists = cache.blob_exists(blob)
+    assert cache.blob_exists(blob) == exists
+    assert cache.misses == misses + 1
+    assert cache.hits == hits + 1
+
+    # lookups of the config bucket are served from the cache
+    assert lookup_extract_bucket(config_data)
+    assert cache.misses == misses + 1
+
+    # own writes update the cached entry
+    blob.upload_from_string('')
+    cache.mark_written(blob)
+    assert cache.blob_exists(blob) is True
+
+    # Clean up
+    blob.delete()
+    cache.mark_deleted(blob)
+    assert cache.blob_exists(blob) is False
+
+
+def test_get_partition_metadata(config_data):
+    partition_metadata = get_partition_metadata(config_data)
+    assert partition_metadata is not None
+
+    for partition_id, metadata in partition_metadata.items():
+        assert partition_id == datetime.strptime(partition_id, "%Y%m%d").strftime('%Y%m%d')
+        assert metadata["last_modified_time"] is not None
+
+
+def test_get_changed_partitions():
+    known_partitions = {"20190101": {"last_modified_time": 1}, "20190102": {"last_modified_time": 1}}
+    partitions = {"20190101": {"last_modified_time": 1},
+                  "20190102": {"last_modified_time": 2},
+                  "20190103": {"last_modified_time": 1}}
+
+    assert get_changed_partitions(known_partitions, partitions) == ["20190102", "20190103"]
+    assert get_changed_partitions(partitions, partitions) == []
+
+
+def test_get_retry_time():
+    # retried on the next poll, then after 2, 4 ... polls, at most an auto healing interval apart
+    assert get_retry_time((1, 1000), 300, 3600) == 1300
+    assert get_retry_time((2, 1000), 300, 3600) == 1600
+    assert get_retry_time((3, 1000), 300, 3600) == 2200
+    assert get_retry_time((10, 1000), 300, 3600) == 4600
+
+
+def test_get_source_location(config_data):
+    source_location = get_source_location(config_data)
+    assert source_location is not None
+    assert config_data.source_location == source_location
+
+
+def test_locations_compatible():
+    assert locations_compatible("US", "US")
+    assert locations_compatible("US", "US-CENTRAL1")
+    assert locations_compatible("EU", "europe-west1")
+    assert locations_compatible("europe-west2", "EUROPE-WEST2")
+    assert not locations_compatible("US", "EU")
+    assert not locations_compatible("EU", "US-EAST1")
+    assert not locations_compatible("europe-west2", "EU")
+    assert not locations_compatible("EU", "europe-west2")
+    assert not locations_compatible("EU", "EUROPE-WEST6")
+    assert not locations_compatible("US", "us-unknown9")
+
+
+def test_export_queue():
+    queue = ExportQueue(0.25)
+    for export_date in ["20190101", "20190102", "20190103", "20190104", "20190105", "20190106"]:
+        queue.add(export_date, "new")
+    queue.add("20190103", "failed")
+
+    assert len(queue) == 6
+    assert "20190103" in queue
+    assert queue.pop() == ("20190106", {"new"})
+    # a quarter of the slots go to the oldest partitions
+    assert queue.pop() == ("20190101", {"new"})
+    assert queue.pop() == ("20190105", {"new"})
+    assert queue.pop() == ("20190104", {"new"})
+    assert queue.pop() == ("20190103", {"new", "failed"})
+    assert queue.pop() == ("20190102", {"new"})
+    assert len(queue) == 0
+
+
+def test_partition_restated():
+    extract_record = {"run_timestamp": "20190102 10:00:00.000", "export_date_partition": "20190101",
+                      "bytes": 100, "status": "success", "exported_timestamp": "20190102 10:05:00.000"}
+
+    assert partition_restated(extract_record, {"last_modified_time": datetime(2019, 1, 3, tzinfo=timezone.utc)})
+    assert not partition_restated(extract_record, {"last_modified_time": datetime(2019, 1, 2, 9, tzinfo=timezone.utc)})
+
+    # modified while the partition was exported, after the extract job was submitted
+    extract_record["extract_submitted_timestamp"] = "20190102 10:01:00.000"
+    assert partition_restated(extract_record, {"last_modified_time": datetime(2019, 1, 2, 10, 3, tzinfo=timezone.utc)})
+    assert not partition_restated(extract_record, {"last_modified_time": datetime(2019, 1, 2, 10, 0, tzinfo=timezone.utc)})
+
+    extract_record.pop("status")
+    assert not partition_restated(extract_record, {"last_modified_time": datetime(2019, 1, 3, tzinfo=timezone.utc)})
+
+    # record of an exporter version without read time, migrated to the current modification time once
+    legacy_record = {"run_timestamp": "20190102 10:00:00.000", "export_date_partition": "20190101", "bytes": 100, "status": "success"}
+    assert not partition_restated(legacy_record, {"last_modified_time": datetime(2019, 1, 3, tzinfo=timezone.utc)})
+    assert legacy_record["extract_submitted_timestamp"] == "20190103 00:00:00.000"
+    assert not partition_restated(legacy_record, {"last_modified_time": datetime(2019, 1, 3, tzinfo=timezone.utc)})
+    assert partition_restated(legacy_record, {"last_modified_time": datetime(2019, 1, 4, tzinfo=timezone.utc)})
+
+
+def test_batched():
+    assert list(batched(list(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 100)) == []
+
+
+def test_promote_partition(config_data):
+    test_date = "19000101"
+    staging_prefix = get_staging_prefix(config_data, test_date)
+    partition_prefix = "{}/{}/".format(config_data.table_id, test_date)
+
+    config_data.gcs_bucket.blob(staging_prefix + "billing-export-000000000000.json").upload_from_string('{"cost": 1}\n')
+    config_data.gcs_bucket.blob(partition_prefix + "billing-export-000000000000.json").upload_from_string('{"cost": 2}\n')
+    config_data.gcs_bucket.blob(partition_prefix + "billing-export-000000000001.json").upload_from_string('{"cost": 3}\n')
+
+    promote_partition(config_data, test_date, 12)
+
+    assert [blob.name for blob in config_data.gcs_bucket.list_blobs(prefix=staging_prefix)] == []
+    partition_blob_names = sorted(blob.name for blob in config_data.gcs_bucket.list_blobs(prefix=partition_prefix))
+    assert partition_blob_names == [partition_prefix + COMMIT_MARKER, partition_prefix + "billing-export-000000000000.json"]
+    commit_marker = json.loads(config_data.gcs_bucket.blob(partition_prefix + COMMIT_MARKER).download_as_string())
+    assert commit_marker["shards"] == ["billing-export-000000000000.json"]
+
+    # Clean up
+    delete_blobs(config_data, partition_blob_names)
+
+
+def test_commit_unmarked_partition(config_data):
+    test_date = "19000102"
+    partition_prefix = "{}/{}/".format(config_data.table_id, test_date)
+
+    config_data.gcs_bucket.blob(partition_prefix + "billing-export-000000000000.json").upload_from_string('{"cost": 2}\n')
+
+    commit_unmarked_partition(config_data, test_date, 12)
+
+    commit_marker = json.loads(config_data.gcs_bucket.blob(partition_prefix + COMMIT_MARKER).download_as_string())
+    assert commit_marker["shards"] == ["billing-export-000000000000.json"]
+    assert commit_marker["bytes"] == 12
+    assert commit_marker["label_index"] is None
+
+    # Clean up
+    delete_blobs(config_data, [partition_prefix + COMMIT_MARKER, partition_prefix + "billing-export-000000000000.json"])
+
+
+def test_get_failed_partitions():
+    data = set_extract_status_json_data()
+    data['extract_status'] = [
+        {"run_timestamp": "20190103 10:00:00.000", "export_date_partition": "20190103"},
+        {"run_timestamp": "20190102 10:00:00.000", "export_date_partition": "20190102", "bytes": 100, "status": "success"},
+        {"run_timestamp": "20190101 10:00:00.000", "export_date_partition": "20190101"}]
+
+    assert get_failed_partitions(data) == ["20190103", "20190101"]
+
+
+def test_label_index_builder():
+    lines = [json.dumps(row).encode("utf-8") + b"\n" for row in [
+        {"cost": 1.5, "usage_start_time": "2019-01-01 05:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]},
+        {"cost": 0.5, "usage_start_time": "2019-01-01 03:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]},
+        {"cost": 2.5, "usage_start_time": "2019-01-01 07:00:00 UTC", "labels": []},
+        {"cost": 1.0, "usage_start_time": "2019-01-01 04:00:00 UTC", "labels": [{"key": "env", "value": "prod"}, {"key": "team", "value": "web"}]}]]
+
+    label_index = LabelIndexBuilder("20190101")
+    assert label_index.add_shard("billing-export-000000000000.json", lines) == 4
+
+    index = json.loads(label_index.to_json())
+    shard = index["shards"]["billing-export-000000000000.json"]
+    assert shard["rows"] == 4
+    assert shard["bytes"] == sum(len(line) for line in lines)
+    assert (shard["min_cost"], shard["max_cost"]) == (0.5, 2.5)
+    assert (shard["min_usage_start_time"], shard["max_usage_start_time"]) == ("2019-01-01 03:00:00 UTC", "2019-01-01 07:00:00 UTC")
+
+    offset = len(lines[0]) + len(lines[1]) + len(lines[2])
+    assert index["labels"]["env"]["prod"]["billing-export-000000000000.json"] == [[0, 2, 0, len(lines[0]) + len(lines[1])],
+                                                                                  [3, 4, offset, offset + len(lines[3])]]
+    assert index["labels"]["team"]["web"]["billing-export-000000000000.json"] == [[3, 4, offset, offset + len(lines[3])]]
+
+
+def test_percentile():
+    values = [5, 1, 4, 2, 3, None]
+
+    assert percentile(values, 50) == 3
+    assert percentile(values, 90) == 5
+    assert percentile([7], 99) == 7
+    assert percentile([None], 50) is None
+
+
+def test_run_history(config_data):
+    history_file = os.path.join(config_data.table_id, "process_status", "test_run_history.db")
+    if os.path.exists(history_file):
+        os.remove(history_file)
+
+    for run_number in range(5):
+        stats = RunStats("delta")
+        stats.run_id = "20190101 10:00:0{}.000".format(run_number)
+        stats.phases = {"extract": 8.0, "verify": 2.0, "promote": 0.0}
+        stats.bytes = 10 ** 9 if run_number < 4 else 4 * 10 ** 8
+        stats.partitions = 1
+        append_run_history(history_file, config_data.table_id, stats, completed=run_number > 0)
+
+    runs = read_run_history(history_file)
+    assert [run["completed"] for run in runs] == [0, 1, 1, 1, 1]
+    assert runs[0]["phases"] == {"extract": 8.0, "verify": 2.0, "promote": 0.0}
+    assert runs[0]["export_seconds_per_gb"] == 10.0
+    assert runs[0]["verification_overhead"] == 0.2
+
+    # the last run takes 10 seconds for 0.4 GB, 2.5 x the 10 s/GB of the previous runs
+    slow_runs = find_slow_runs(runs, 10, 1.5)
+    assert [run["run_id"] for run in slow_runs] == ["20190101 10:00:04.000"]
+    assert slow_runs[0]["baseline_seconds_per_gb"] == 10.0
+    assert find_slow_runs(runs, 10, 3) == []
+
+    # Clean up
+    os.remove(history_file)
+
+
+def test_run_stats_idle(config_data):
+    # a daemon run waiting for the next poll, the wait is not part of its duration
+    stats = RunStats("daemon", config_data.gcs_metadata_cache.misses)
+    with stats.idle():
+        time.sleep(0.5)
+    with stats.phase("extract"):
+        time.sleep(0.1)
+    assert stats.idle_seconds >= 0.5
+    assert 0.1 <= stats.duration() < 0.4
+
+
+def test_get_sub_ranges(config_data):
+    config_data.partition_metadata = {"20190101": {"total_rows": 10, "total_logical_bytes": 100, "last_modified_time": datetime(2019, 1, 2)},
+                                      "20190102": {"total_rows": 10, "total_logical_bytes": 300, "last_modified_time": datetime(2019, 1, 3)}}
+    # the split is opt-in, every sub-range query is billed for the whole partition
+    assert get_sub_ranges(config_data, "20190102") == []
+    config_data.split_partition_bytes = 200
+
+    config_data.split_by = "hour"
+    assert get_sub_ranges(config_data, "20190101") == []
+    assert get_sub_ranges(config_data, "20190102") == ["h{:02d}".format(hour) for hour in range(24)]
+    assert "IFNULL(EXTRACT(HOUR FROM usage_start_time), 0) = 7" in get_sub_range_query(config_data, "20190102", "h07")
+
+    config_data.split_by = "hash"
+    config_data.split_ranges = 4
+    assert get_sub_ranges(config_data, "20190102") == ["b00", "b01", "b02", "b03"]
+    assert "MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(t))), 4) = 2" in get_sub_range_query(config_data, "20190102", "b02")
+    assert "/_staging/20190102/billing-export-b02-*.json" in get_sub_range_query(config_data, "20190102", "b02")
+
+    config_data.split_partition_bytes = None
+
+
+def test_get_completed_sub_ranges():
+    extract_record = {"run_timestamp": "20190103 10:00:00.000", "export_date_partition": "20190102",
+                      "sub_ranges": {"b00": "success", "b01": "started", "b02": "success"}}
+    metadata = {"total_rows": 10, "total_logical_bytes": 300, "last_modified_time": datetime(2019, 1, 3, 9, tzinfo=timezone.utc)}
+
+    assert get_completed_sub_ranges(extract_record, ["b00", "b01", "b02"], metadata) == ["b00", "b02"]
+    # split differently, modified since the interrupted export, or exported completely
+    assert get_completed_sub_ranges(extract_record, ["b00", "b01"], metadata) == []
+    assert get_completed_sub_ranges(extract_record, ["b00", "b01", "b02"], dict(metadata, last_modified_time=datetime(2019, 1, 3, 11))) == []
+
+    # modified after the first attempt, the attempt started over after the modification is resumed
+    extract_record["sub_ranges_started"] = "20190103 12:00:00.000"
+    assert get_completed_sub_ranges(extract_record, ["b00", "b01", "b02"], dict(metadata, last_modified_time=datetime(2019, 1, 3, 11))) == ["b00", "b02"]
+    # re-export of a partition exported before, the record keeps its status
+    assert get_completed_sub_ranges(dict(extract_record, status="success"), ["b00", "b01", "b02"], metadata) == ["b00", "b02"]
+
+
+def test_parallel_transfer(config_data):
+    transfer = ParallelTransfer(config_data.storage_client, 4, 100, 300)
+
+    assert transfer.get_ranges(250) == [(0, 100), (100, 200), (200, 250)]
+    assert transfer.get_ranges(6500, COMPOSE_MAX_COMPONENTS) == [(start, min(start + 204, 6500)) for start in range(0, 6500, 204)]
+    assert not transfer.is_parallel(299)
+
+    # composed from 10 parts, downloaded in 10 byte ranges
+    data = os.urandom(1000)
+    blob = config_data.gcs_bucket.blob("{}/process_status/test_parallel_transfer.bin".format(config_data.table_id))
+    transfer.upload_from_string(blob, data, content_type="application/octet-stream")
+    assert transfer.download_as_string(config_data.gcs_bucket.get_blob(blob.name)) == data
+    # without a known size, downloaded in one request
+    assert not transfer.is_parallel_download(config_data.gcs_bucket.blob(blob.name))
+    assert transfer.download_as_string(config_data.gcs_bucket.blob(blob.name)) == data
+    assert [name for name in (listed.name for listed in config_data.gcs_bucket.list_blobs(prefix=blob.name)) if name != blob.name] == []
+
+    # no part uploaded, the error of the upload is raised
+    def read_part(start, end):
+        raise IOError("read of part {}-{} failed".format(start, end))
+    try:
+        transfer.compose_parts(blob, 1000, read_part, "application/octet-stream")
+        assert False
+    except IOError:
+        pass
+
+    # Clean up
+    blob.delete()
@@ -0,0 +1,126 @@
+############ DISCLAIMER ####################
+# Copyright 2019 Google LLC. This software is provided as-is, without warranty or representation 
+# for any use or purpose. Your use of it is subject to your agreement with Google. 
+############################################
+
+from src.export import *
+import src.label_index
+
+from src.label_index import LabelIndexReader, PartitionPublishedAgain, UncommittedPartition, merge_ranges, row_has_label, shard_in_usage_range
+
+
+def test_merge_ranges():
+    assert merge_ranges([[4, 6, 40, 60], [0, 2, 0, 20], [2, 3, 20, 30]]) == [[0, 3, 0, 30], [4, 6, 40, 60]]
+    assert merge_ranges([]) == []
+
+
+def test_shard_in_usage_range():
+    shard = {"min_usage_start_time": "2019-01-01 03:00:00 UTC", "max_usage_start_time": "2019-01-01 07:00:00 UTC"}
+
+    assert shard_in_usage_range(shard)
+    assert shard_in_usage_range(shard, "2019-01-01 06:00:00 UTC", "2019-01-01 08:00:00 UTC")
+    assert not shard_in_usage_range(shard, "2019-01-01 08:00:00 UTC")
+    assert not shard_in_usage_range(shard, usage_start_time_to="2019-01-01 03:00:00 UTC")
+
+
+def test_row_has_label():
+    row = {"labels": [{"key": "env", "value": "prod"}]}
+
+    assert row_has_label(row, "env")
+    assert row_has_label(row, "env", "prod")
+    assert not row_has_label(row, "env", "dev")
+    assert not row_has_label({"labels": None}, "env")
+
+
+def test_read_rows(config_data, monkeypatch):
+    test_date = "19000101"
+    staging_prefix = get_staging_prefix(config_data, test_date)
+    partition_prefix = "{}/{}/".format(config_data.table_id, test_date)
+    rows = [{"cost": 1.0, "usage_start_time": "1900-01-01 01:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]},
+            {"cost": 2.0, "usage_start_time": "1900-01-01 02:00:00 UTC", "labels": [{"key": "env", "value": "dev"}]},
+            {"cost": 3.0, "usage_start_time": "1900-01-01 03:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]}]
+    data = "".join(json.dumps(row) + "\n" for row in rows)
+
+    shard_blob = config_data.gcs_bucket.blob(staging_prefix + "billing-export-000000000000.json")
+    shard_blob.upload_from_string(data)
+    label_index = LabelIndexBuilder(test_date)
+    label_index.add_shard("billing-export-000000000000.json", data.encode("utf-8").splitlines(True))
+    promote_partition(config_data, test_date, len(data), label_index)
+
+    # byte ranges read in chunks smaller than a row
+    monkeypatch.setattr(src.label_index, "READ_CHUNK_BYTES", 10)
+    reader = LabelIndexReader(config_data.bucket_name, config_data.table_id, config_data.storage_client)
+    assert list(reader.read_rows(test_date, "19000102", "env", "prod")) == [rows[0], rows[2]]
+    assert list(reader.read_rows(test_date, "19000102", "env")) == rows
+    assert list(reader.read_rows(test_date, "19000102", "env", "prod", usage_start_time_from="1900-01-01 02:00:00 UTC")) == [rows[2]]
+    assert list(reader.read_rows(test_date, "19000102", "team")) == []
+
+    # Clean up
+    delete_blobs(config_data, [blob.name for blob in config_data.gcs_bucket.list_blobs(prefix=partition_prefix)])
+
+
+def test_read_rows_without_label_index(config_data, monkeypatch):
+    test_date = "19000101"
+    partition_prefix = "{}/{}/".format(config_data.table_id, test_date)
+    rows = [{"cost": 1.0, "usage_start_time": "1900-01-01 01:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]},
+            {"cost": 2.0, "usage_start_time": "1900-01-01 02:00:00 UTC", "labels": [{"key": "env", "value": "dev"}]}]
+    data = "".join(json.dumps(row) + "\n" for row in rows)
+    config_data.gcs_bucket.blob(partition_prefix + "billing-export-000000000000.json").upload_from_string(data)
+
+    # export files without committed marker are not skipped silently
+    monkeypatch.setattr(src.label_index, "PUBLISH_WAIT_SECONDS", 0)
+    reader = LabelIndexReader(config_data.bucket_name, config_data.table_id, config_data.storage_client)
+    try:
+        list(reader.read_rows(test_date, "19000102", "env", "prod"))
+        assert False
+    except UncommittedPartition:
+        pass
+
+    # committed without label index, the export files are scanned
+    commit_unmarked_partition(config_data, test_date, len(data))
+    reader = LabelIndexReader(config_data.bucket_name, config_data.table_id, config_data.storage_client)
+    assert list(reader.read_rows(test_date, "19000102", "env", "prod")) == [rows[0]]
+
+    # Clean up
+    delete_blobs(config_data, [blob.name for blob in config_data.gcs_bucket.list_blobs(prefix=partition_prefix)])
+
+
+def test_read_rows_published_again(config_data):
+    test_date = "19000101"
+    staging_prefix = get_staging_prefix(config_data, test_date)
+    partition_prefix = "{}/{}/".format(config_data.table_id, test_date)
+    reader = LabelIndexReader(config_data.bucket_name, config_data.table_id, config_data.storage_client)
+
+    for rows in ([{"cost": 1.0, "usage_start_time": "1900-01-01 01:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]}],
+                 [{"cost": 2.0, "usage_start_time": "1900-01-01 02:00:00 UTC", "labels": [{"key": "team", "value": "web"}]},
+                  {"cost": 30.0, "usage_start_time": "1900-01-01 03:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]}]):
+        data = "".join(json.dumps(row) + "\n" for row in rows)
+        config_data.gcs_bucket.blob(staging_prefix + "billing-export-000000000000.json").upload_from_string(data)
+        label_index = LabelIndexBuilder(test_date)
+        label_index.add_shard("billing-export-000000000000.json", data.encode("utf-8").splitlines(True))
+        promote_partition(config_data, test_date, len(data), label_index)
+
+        # the offsets cached from the previous publication are not applied to the new export files
+        assert list(reader.read_rows(test_date, "19000102", "env", "prod")) == [rows[-1]]
+
+    # published again after rows of the partition were returned, the rows of the new export files are not mixed in
+    rows = [{"cost": 1.0, "usage_start_time": "1900-01-01 01:00:00 UTC", "labels": [{"key": "team", "value": "web"}]},
+            {"cost": 2.0, "usage_start_time": "1900-01-01 02:00:00 UTC", "labels": [{"key": "env", "value": "prod"}]},
+            {"cost": 3.0, "usage_start_time": "1900-01-01 03:00:00 UTC", "labels": [{"key": "team", "value": "db"}]}]
+    data = "".join(json.dumps(row) + "\n" for row in rows)
+    for publication in range(2):
+        config_data.gcs_bucket.blob(staging_prefix + "billing-export-000000000000.json").upload_from_string(data)
+        label_index = LabelIndexBuilder(test_date)
+        label_index.add_shard("billing-export-000000000000.json", data.encode("utf-8").splitlines(True))
+        promote_partition(config_data, test_date, len(data), label_index)
+        if publication == 0:
+            read_rows = reader.read_rows(test_date, "19000102", "team")
+            assert next(read_rows) == rows[0]
+    try:
+        next(read_rows)
+        assert False
+    except PartitionPublishedAgain:
+        pass
+
+    # Clean up
+    delete_blobs(config_data, [blob.name for blob in config_data.gcs_bucket.list_blobs(prefix=partition_prefix)])
@@ -0,0 +1,152 @@
+############ DISCLAIMER ####################
+# Copyright 2019 Google LLC. This software is provided as-is, without warranty or representation
+# for any use or purpose. Your use of it is subject to your agreement with Google.
+############################################
+
+# Benchmark of the parallel transfers of src/export.py (ParallelTransfer) against the local Cloud Storage fake of
+# test/fakes.py, with every upload and download request capped to one stream of --bandwidth bytes per second, as on
+# VMs with limited per-stream bandwidth.
+#
+# For every object size and parallelism, an object is uploaded from a file (parallel composite upload) and downloaded
+# back to a file (parallel byte ranges). Parallelism 1 is the single-stream transfer used before. The harness reports
+# the seconds, throughput and requests of each transfer and checks the downloaded file matches the uploaded one.
+#
+#   $ python3 test/transfer_benchmark.py
+#   $ python3 test/transfer_benchmark.py --sizes 32 256 --parallelism 1 8 16 --bandwidth 25 --output results.json
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fakes
+
+BUCKET_NAME = "billing-export-transfer-benchmark"
+MB = 1024 ** 2
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(MB), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def count_requests(workdir, run_id):
+    return sum(1 for entry in fakes.read_ledger(workdir) if entry["run"] == run_id)
+
+
+def run_transfer(workdir, bucket, transfer, filename, size, parallelism):
+    blob_name = "benchmark/{}-{}.bin".format(size, parallelism)
+
+    os.environ["FAKE_RUN_ID"] = "upload-{}-{}".format(size, parallelism)
+    started = time.time()
+    transfer.upload_from_filename(bucket.blob(blob_name), filename)
+    upload_seconds = time.time() - started
+    upload_requests = count_requests(workdir, os.environ["FAKE_RUN_ID"])
+
+    download_file = filename + ".download"
+    os.environ["FAKE_RUN_ID"] = "download-{}-{}".format(size, parallelism)
+    started = time.time()
+    transfer.download_to_filename(bucket.get_blob(blob_name), download_file)
+    download_seconds = time.time() - started
+    download_requests = count_requests(workdir, os.environ["FAKE_RUN_ID"])
+
+    identical = file_digest(download_file) == file_digest(filename)
+    os.remove(download_file)
+    bucket.delete_blob(blob_name)
+
+    return {"size_mb": size // MB, "parallelism": parallelism,
+            "upload_seconds": round(upload_seconds, 3), "upload_mb_per_second": round(size / MB / upload_seconds, 1),
+            "upload_requests": upload_requests,
+            "download_seconds": round(download_seconds, 3), "download_mb_per_second": round(size / MB / download_seconds, 1),
+            "download_requests": download_requests,
+            "identical": identical}
+
+
+def run_benchmark(workdir, sizes, parallelisms, chunk_bytes):
+    from src.export import ParallelTransfer
+
+    fakes.create_backends(workdir, BUCKET_NAME, {})
+    storage_client = fakes.FakeStorageClient()
+    bucket = storage_client.bucket(BUCKET_NAME)
+
+    results = []
+    for size in sizes:
+        filename = os.path.join(workdir, "object-{}.bin".format(size))
+        with open(filename, "wb") as f:
+            for start in range(0, size, MB):
+                f.write(os.urandom(min(MB, size - start)))
+
+        for parallelism in parallelisms:
+            # every object is transferred in parts from chunk_bytes up, parallelism 1 is a single stream
+            transfer = ParallelTransfer(storage_client, parallelism, chunk_bytes, chunk_bytes)
+            results.append(run_transfer(workdir, bucket, transfer, filename, size, parallelism))
+            transfer.executor.shutdown()
+
+        os.remove(filename)
+
+    return results
+
+
+def print_results(results):
+    single_stream = {result["size_mb"]: result for result in results if result["parallelism"] == 1}
+
+    print("{:>8} {:>8} {:>10} {:>10} {:>8} {:>9} {:>10} {:>10} {:>8} {:>9} {:>10}".format(
+        "MB", "streams", "upload s", "MB/s", "reqs", "speedup", "download s", "MB/s", "reqs", "speedup", "identical"))
+    for result in results:
+        baseline = single_stream.get(result["size_mb"])
+        print("{:>8} {:>8} {:>10} {:>10} {:>8} {:>9} {:>10} {:>10} {:>8} {:>9} {:>10}".format(
+            result["size_mb"], result["parallelism"],
+            result["upload_seconds"], result["upload_mb_per_second"], result["upload_requests"],
+            "-" if baseline is None else "x{:.1f}".format(baseline["upload_seconds"] / result["upload_seconds"]),
+            result["download_seconds"], result["download_mb_per_second"], result["download_requests"],
+            "-" if baseline is None else "x{:.1f}".format(baseline["download_seconds"] / result["download_seconds"]),
+            str(result["identical"])))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark parallel GCS transfers of the billing exporter against a local fake')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 128], help='Object sizes in MB, default 16 128')
+    parser.add_argument('--parallelism', type=int, nargs='+', default=[1, 4, 8, 16], help='Parallel streams, default 1 4 8 16')
+    parser.add_argument('--chunk_mb', type=int, default=8, help='Part and byte range size in MB, default 8')
+    parser.add_argument('--bandwidth', type=float, default=50, help='Bandwidth of one stream in MB per second, default 50')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every fake API call, default 0.02')
+    parser.add_argument('--output', type=str, help='Write the results as json to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    opts = parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="billing-export-transfer-")
+    os.environ.update(FAKE_ROOT=workdir, FAKE_LATENCY=str(opts.latency), FAKE_STREAM_BANDWIDTH=str(opts.bandwidth * MB))
+    os.environ.pop("FAKE_FAULT_POINT", None)
+
+    fakes.install()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import src.export
+        src.export.logger.setLevel(logging.WARNING)
+
+        results = run_benchmark(workdir, [size * MB for size in opts.sizes], opts.parallelism, opts.chunk_mb * MB)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    print_results(results)
+
+    if opts.output is not None:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=4)